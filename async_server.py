@@ -0,0 +1,30 @@
+"""
+Serve the API on gevent, one greenlet per connection.
+
+    $ python async_server.py
+
+Blocking socket calls, the mongo driver's included, yield to other
+greenlets, so one process can hold many slow or idle device connections
+instead of one request per worker. AsyncConfig turns on the driver's
+per-greenlet socket pool. Only the api blueprint and the OAuth token
+endpoints are served; the website, including the authorize page, stays
+on the regular WSGI deployment.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from mgserver import create_app
+from mgserver.api import api
+from mgserver.configs import AsyncConfig
+
+
+app = create_app(AsyncConfig, blueprints=(api,))
+
+
+if __name__ == "__main__":
+    server = WSGIServer((app.config["ASYNC_HOST"], app.config["ASYNC_PORT"]),
+                        app,
+                        spawn=Pool(app.config["ASYNC_MAX_CONNECTIONS"]))
+    server.serve_forever()
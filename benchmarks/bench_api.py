@@ -0,0 +1,170 @@
+"""
+Drive the OAuth 1.0 flow and the signed API calls against an in-process app.
+
+    $ python benchmarks/bench_api.py [--requests N] [--devices N]
+                                     [--memory | --mongomock]
+
+A seeded user goes through request token, authorize and access token,
+then /v1/me, /v1/device and /v1/devices are called with signed requests.
+Reported per endpoint: throughput, p50/p99 latency and mongo operations
+per request. The app talks to the mongod in MONGO_HOST/MONGO_PORT, in
+the mgserver_benchmark database, unless --memory (the in-process storage
+engine) or --mongomock is given.
+"""
+import sys
+import os
+import time
+import urlparse
+from optparse import OptionParser
+from bson.objectid import ObjectId
+from flask import json
+from oauthlib.oauth1.rfc5849 import Client as OAuthClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mgserver import create_app
+from mgserver.app import mongo_calls
+from mgserver.configs import BaseConfig
+from mgserver.database import MongoConnection, ensure_indexes
+from mgserver.database import create_user, create_client
+from mgserver.database import AccessToken
+from mgserver.database import get_or_create_device
+from mgserver.extensions import mongo, totp
+
+
+CALLBACK = u"http://localhost/callback"
+
+
+class BenchConfig(BaseConfig):
+
+    MONGO_DATABASE = "mgserver_benchmark"
+    MONGO_ENSURE_INDEXES = False # built after the database is dropped
+    BCRYPT_LOG_ROUNDS = 4
+    METRICS_ENABLED = True
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def signed(http, signer, method, path):
+    """Send a request signed for http://localhost + path."""
+    _, headers, _ = signer.sign(u"http://localhost" + path, method)
+    return http.open(path, method=method, headers=headers)
+
+
+def parse(response):
+    assert response.status_code == 200, (response.status_code, response.data)
+    return dict(urlparse.parse_qsl(response.data))
+
+
+def setup(app, devices):
+    """Create the app's client and extra devices of a seeded user."""
+    with app.test_request_context():
+        mongo.client.drop_database(app.config["MONGO_DATABASE"])
+        ensure_indexes()
+        owner = create_user(u"bench@example.com", u"bench", u"Bench")
+        client = create_client(owner, u"Bench app", u"Benchmark client", CALLBACK)
+
+    http = app.test_client()
+    response = http.post("/v1/seeds", data={
+            "otp": str(totp.now()),
+            "consumer_key": client["client_key"],
+            })
+    user_id = json.loads(response.data)["user_id"]
+
+    with app.test_request_context():
+        for i in xrange(devices):
+            token = AccessToken(token=u"bench_token_%d" % i)
+            token["resource_owner_id"] = ObjectId(user_id)
+            token["client_id"] = client["_id"]
+            AccessToken.insert(token)
+            get_or_create_device(token)
+    return http, client, user_id
+
+
+def authorize(http, client, user_id):
+    """request token -> authorize -> access token, returns a signing client."""
+    signer = OAuthClient(client["client_key"], client_secret=client["secret"],
+                         callback_uri=CALLBACK)
+    request_token = parse(signed(http, signer, u"POST", u"/v1/request_token?realm=users"))
+
+    response = http.get("/v1/authorize", query_string={
+            "oauth_token": request_token["oauth_token"],
+            "uid": user_id,
+            })
+    assert response.status_code == 302, (response.status_code, response.data)
+    verifier = dict(urlparse.parse_qsl(
+            urlparse.urlsplit(response.headers["Location"]).query))["oauth_verifier"]
+
+    signer = OAuthClient(client["client_key"], client_secret=client["secret"],
+                         resource_owner_key=request_token["oauth_token"],
+                         resource_owner_secret=request_token["oauth_token_secret"],
+                         verifier=unicode(verifier))
+    access_token = parse(signed(http, signer, u"POST", u"/v1/access_token"))
+
+    return OAuthClient(client["client_key"], client_secret=client["secret"],
+                       resource_owner_key=access_token["oauth_token"],
+                       resource_owner_secret=access_token["oauth_token_secret"])
+
+
+def run(http, signer, path, endpoint, count):
+    """Time count signed GETs of path, mongo ops are read from the metrics."""
+    calls_before = mongo_calls.count(endpoint), mongo_calls.sum(endpoint)
+    latencies = []
+    started = time.time()
+    for _ in xrange(count):
+        _, headers, _ = signer.sign(u"http://localhost" + path, u"GET")
+        start = time.time()
+        response = http.get(path, headers=headers)
+        response.data # a streamed body is only produced when read
+        latencies.append(time.time() - start)
+        assert response.status_code == 200, (path, response.status_code, response.data)
+    elapsed = time.time() - started
+
+    calls = mongo_calls.count(endpoint) - calls_before[0]
+    ops = mongo_calls.sum(endpoint) - calls_before[1]
+    print "%-14s %8.1f req/s  p50 %6.2f ms  p99 %6.2f ms  %5.1f mongo ops/req" % (
+        path, count / elapsed,
+        percentile(latencies, 0.50) * 1000,
+        percentile(latencies, 0.99) * 1000,
+        float(ops) / calls if calls else 0.0)
+
+
+def main():
+    options = OptionParser(usage=__doc__.strip())
+    options.add_option("--requests", type="int", default=500,
+                       help="signed requests per endpoint")
+    options.add_option("--devices", type="int", default=50,
+                       help="devices of the benchmark user")
+    options.add_option("--memory", action="store_true",
+                       help="use the in-memory storage engine")
+    options.add_option("--mongomock", action="store_true",
+                       help="run against mongomock instead of a mongod")
+    opts, _ = options.parse_args()
+
+    if opts.memory:
+        BenchConfig.STORAGE_ENGINE = "memory"
+    elif opts.mongomock:
+        import mongomock
+
+        class MockClient(mongomock.MongoClient):
+            # pool and read preference settings don't apply here
+            def __init__(self, host=None, port=None, **kwargs):
+                super(MockClient, self).__init__()
+        MongoConnection.client_class = MockClient
+
+    app = create_app(BenchConfig)
+    http, client, user_id = setup(app, opts.devices)
+
+    started = time.time()
+    signer = authorize(http, client, user_id)
+    print "oauth flow     %8.2f ms" % ((time.time() - started) * 1000)
+
+    run(http, signer, "/v1/me", "api.myself", opts.requests)
+    run(http, signer, "/v1/device", "api.devices", opts.requests)
+    run(http, signer, "/v1/devices", "api.devices", opts.requests)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Compare flask-restful's marshal with the compiled marshallers.
+
+    $ python benchmarks/bench_marshal.py [devices] [repeat]
+"""
+import sys
+import os
+import timeit
+import uuid
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from flask.ext.restful import marshal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mgserver.api import device_fields, marshal_device
+
+
+def make_devices(count):
+    now = datetime.utcnow()
+    return [{
+        "_id": ObjectId(),
+        "name": u"Device %d" % i,
+        "description": u"Benchmark device",
+        "vendor": u"Avamagic",
+        "model": u"MGServer Client",
+        "features": [],
+        "mgserver_id": uuid.uuid4(),
+        "access_token_id": ObjectId(),
+        "created_at": now - timedelta(days=1),
+        "updated_since": now - timedelta(seconds=i),
+        } for i in xrange(count)]
+
+
+def main(count=10000, repeat=5):
+    devices = make_devices(count)
+    assert [marshal(d, device_fields) for d in devices] == \
+        [marshal_device(d) for d in devices]
+
+    generic = min(timeit.repeat(
+        lambda: [marshal(d, device_fields) for d in devices],
+        repeat=repeat, number=1))
+    compiled = min(timeit.repeat(
+        lambda: [marshal_device(d) for d in devices],
+        repeat=repeat, number=1))
+
+    print "%d devices, best of %d" % (count, repeat)
+    print "marshal:  %8.1f ms" % (generic * 1000)
+    print "compiled: %8.1f ms" % (compiled * 1000)
+    print "speedup:  %8.1fx" % (generic / compiled)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
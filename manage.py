@@ -1,10 +1,45 @@
+import time
+from pprint import pprint
 from flask.ext.script import Manager
 from mgserver import create_app
+from mgserver.database import ensure_indexes, index_report
+from mgserver.database import sweep, migrate_ownership
 
 
 app = create_app()
 manager = Manager(app)
 
 
+@manager.command
+def create_indexes():
+    """Build the indexes declared by the models, rebuilding changed ones."""
+    for name in ensure_indexes(rebuild=True):
+        print name
+
+
+@manager.command
+def check_indexes():
+    """Report missing, unused and changed indexes."""
+    pprint(index_report())
+
+
+
+@manager.command
+def sweep_tokens(loop=False):
+    """Remove expired tokens and dangling ids, every SWEEPER_INTERVAL with --loop."""
+    while True:
+        pprint(sweep())
+        if not loop:
+            break
+        time.sleep(app.config["SWEEPER_INTERVAL"])
+
+
+
+@manager.command
+def migrate_owners():
+    """Give devices a resource_owner_id and drop the users' id arrays."""
+    pprint(migrate_ownership(app.config["SWEEPER_BATCH_SIZE"]))
+
+
 if __name__ == "__main__":
     manager.run()
@@ -1,3 +1,4 @@
 from .views import api
 from .utils import user_fields, device_fields
 from .utils import Epoch
+from .utils import compile_marshaller, marshal_user, marshal_device
@@ -1,4 +1,10 @@
+import base64
 import calendar
+import hashlib
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from flask import json, request, Response
 from flask.ext.restful import reqparse, fields
 
 
@@ -13,6 +19,13 @@ parser.add_argument("model", type=str)
 parser.add_argument("consumer_key", type=str)
 
 
+list_parser = reqparse.RequestParser()
+list_parser.add_argument("limit", type=int, location="args")
+list_parser.add_argument("cursor", type=str, location="args")
+list_parser.add_argument("fields", type=str, location="args")
+list_parser.add_argument("ids", type=str, location="args")
+
+
 class Epoch(fields.Raw):
     """Return a Unix time-formatted datetime string in UTC"""
     def format(self, value):
@@ -22,6 +35,67 @@ class Epoch(fields.Raw):
             raise fields.MarshallingException(ae)
 
 
+_marshallers = {}
+
+
+def cached_marshaller(field_spec):
+    """compile_marshaller, memoized for specs built at request time."""
+    key = frozenset(field_spec.items())
+    if key not in _marshallers:
+        _marshallers[key] = compile_marshaller(field_spec)
+    return _marshallers[key]
+
+
+_MARSHALLER_TEMPLATE = """\
+def marshaller(obj):
+    get = obj.get
+%s
+    return {
+%s
+        }
+"""
+
+
+def compile_marshaller(field_spec):
+    """Build a function returning the same as marshal(obj, field_spec).
+
+    The spec is looked at once: String, Epoch and List(String) fields are
+    inlined into generated code, any other field falls back to its own
+    output(). Only dict documents are supported, and a plain dict is
+    returned since building an OrderedDict costs more than the fields.
+    """
+    namespace = {
+        "epoch": Epoch().format,
+        }
+    reads, items = [], []
+    for i, (key, field) in enumerate(field_spec.items()):
+        if isinstance(field, type):
+            field = field()
+        namespace["key_%d" % i] = key
+        namespace["field_%d" % i] = field
+        namespace["name_%d" % i] = key if field.attribute is None else field.attribute
+        namespace["default_%d" % i] = field.default
+
+        if type(field) is fields.String:
+            expr = "default_{0} if v{0} is None else unicode(v{0})"
+        elif type(field) is Epoch:
+            expr = "default_{0} if v{0} is None else epoch(v{0})"
+        elif type(field) is fields.List and \
+                type(field.container) is fields.String:
+            namespace["default_%d" % i] = field.container.default
+            expr = "None if v{0} is None else " \
+                "[default_{0} if x is None else unicode(x) for x in v{0}]"
+        else:
+            items.append("        key_{0}: field_{0}.output(key_{0}, obj),"
+                         .format(i))
+            continue
+        reads.append("    v{0} = get(name_{0})".format(i))
+        items.append("        key_{0}: {1},".format(i, expr.format(i)))
+
+    exec _MARSHALLER_TEMPLATE % ("\n".join(reads), "\n".join(items)) in namespace
+    return namespace["marshaller"]
+
+
 user_fields = {
     '_id': fields.String,
     'name': fields.String,
@@ -44,3 +118,95 @@ device_fields = {
     'created_at': Epoch,
     'updated_since': Epoch,
 }
+
+
+def encode_cursor(device):
+    """Opaque position of a device in the (updated_since, _id) ordering."""
+    updated_since = device["updated_since"]
+    micros = calendar.timegm(updated_since.utctimetuple()) * 1000000 + \
+        updated_since.microsecond
+    return base64.urlsafe_b64encode("{}:{}".format(micros, device["_id"]))
+
+
+def decode_cursor(cursor):
+    """Return (updated_since, _id) or raise ValueError."""
+    try:
+        micros, oid = base64.urlsafe_b64decode(cursor).split(":")
+        micros = int(micros)
+        oid = ObjectId(oid)
+    except (TypeError, ValueError, InvalidId):
+        raise ValueError("Invalid cursor: {}".format(cursor))
+    updated_since = datetime.utcfromtimestamp(micros // 1000000) + \
+        timedelta(microseconds=micros % 1000000)
+    return updated_since, oid
+
+
+def select_fields(field_spec, names):
+    """Restrict a field spec to the comma separated names, _id is kept."""
+    if not names:
+        return field_spec
+    selected = {"_id": field_spec["_id"]}
+    for name in names.split(","):
+        name = name.strip()
+        if name not in field_spec:
+            raise ValueError("Unknown field: {}".format(name))
+        selected[name] = field_spec[name]
+    return selected
+
+
+def parse_object_id(value):
+    """ObjectId of value, None if it isn't one."""
+    try:
+        return ObjectId(value)
+    except (TypeError, InvalidId):
+        return None
+
+
+def stream_page(items, limit, marshaller, next_url):
+    """Yield a {"flag", "res", "next"} JSON envelope piece by piece.
+
+    Only one document is marshalled at a time, so memory does not grow
+    with the page size. items may hold one document more than limit,
+    which only tells that next_url(last_item) has to be filled in.
+    """
+    yield '{"flag": "success", "res": ['
+    last = None
+    more = False
+    for count, item in enumerate(items):
+        if count == limit:
+            more = True
+            break
+        yield (", " if count else "") + json.dumps(marshaller(item))
+        last = item
+    yield '], "next": %s}' % json.dumps(next_url(last) if more else None)
+
+
+marshal_user = compile_marshaller(user_fields)
+marshal_device = compile_marshaller(device_fields)
+
+
+def make_etag(*parts):
+    """Strong ETag over the given values."""
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+def add_validators(response, etag, last_modified=None):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def not_modified(etag, last_modified=None):
+    """A 304 response if the client's copy is still current, else None."""
+    if request.if_none_match:
+        matched = request.if_none_match.contains(etag)
+    elif request.if_modified_since and last_modified is not None:
+        # Last-Modified only has a precision of seconds
+        matched = last_modified.replace(microsecond=0) <= \
+            request.if_modified_since
+    else:
+        matched = False
+    if not matched:
+        return None
+    return add_validators(Response(status=304), etag, last_modified)
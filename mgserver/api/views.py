@@ -1,16 +1,22 @@
 from functools import wraps
-from flask import Blueprint, request, abort, jsonify
+from flask import Blueprint, request, abort, jsonify, url_for
 from flask import make_response, json, current_app
+from flask import Response, stream_with_context
 from flask.views import MethodView
-from flask.ext.restful import marshal
 from bson.objectid import ObjectId
 from datetime import datetime
 import pyotp
 from ..common import ApiException
-from ..extensions import bcrypt, provider, totp
+from ..extensions import hasher, provider, totp
 from ..database import ResourceOwner as User, Client, Device
 from ..database import get_user_or_abort, get_client_or_abort, get_device_or_abort
+from ..database import get_user_id_or_abort
+from ..database import get_access_token_or_abort, revoke_access_token
+from ..database import with_owned_ids, invalidate_user
 from .utils import parser, user_fields, device_fields
+from .utils import list_parser, encode_cursor, decode_cursor, select_fields
+from .utils import stream_page, cached_marshaller, marshal_user, marshal_device
+from .utils import make_etag, not_modified, add_validators, parse_object_id
 
 
 api = Blueprint("api", __name__)
@@ -60,7 +66,8 @@ class Seed(MethodView):
                 )
 
         user = User()
-        user.client_ids.append(client["_id"])
+        # the client a seeded user was made for, it may never get a token
+        user.seed_client_ids = [client["_id"]]
         User.save(user)
 
         return jsonify({
@@ -82,37 +89,150 @@ class Myself(MethodView):
         if args["email"]:
             user["email"] = args["email"]
         if args["password"]:
-            user["pw_hash"] = bcrypt.generate_password_hash(args["password"])
+            user["pw_hash"] = hasher.generate(args["password"])
         user["updated_since"] = datetime.utcnow()
-        User.save(user)
+        User.save(user, check_version=True)
+        invalidate_user(user["_id"])
 
         return jsonify({
                 "flag": "success",
-                "res": marshal(user, user_fields),
+                "res": marshal_user(with_owned_ids(user)),
                 })
 
     def get(self):
+        # validate against a projection before loading the whole user
+        user_id = get_user_id_or_abort()
+        stamp = User.find_one({'_id': user_id}, ['updated_since'])
+        if not stamp:
+            raise ApiException(
+                code=404,
+                msg="User {} doesn't exist".format(user_id),
+                )
+        etag = make_etag(user_id, stamp.get('updated_since'))
+        response = not_modified(etag, stamp.get('updated_since'))
+        if response:
+            return response
+
+        # the document may have changed since the projection was read
         user = get_user_or_abort()
-        return jsonify({
+        response = jsonify({
                 "flag": "success",
-                "res": marshal(user, user_fields),
+                "res": marshal_user(with_owned_ids(user)),
                 })
+        return add_validators(response,
+                              make_etag(user['_id'], user.get('updated_since')),
+                              user.get('updated_since'))
 
 
 class DeviceList(MethodView):
 
     decorators = [require_oauth]
 
-    def put(self, device_id):
-        if device_id is None:
+    # fields a batch update may change
+    batch_fields = ("name", "description", "vendor", "model")
+
+    def get_batch(self, key, items=None):
+        """The list under key in the JSON body, checked against the limit."""
+        if items is None:
+            items = (request.json or {}).get(key)
+        if not isinstance(items, list) or not items:
+            raise ApiException(
+                code=400,
+                msg="Expect a non-empty list of {}".format(key),
+                )
+        if len(items) > current_app.config["DEVICES_MAX_BATCH_SIZE"]:
             raise ApiException(
                 code=400,
-                msg="Does not support updating multiple devices",
+                msg="At most {} {} per request".format(
+                    current_app.config["DEVICES_MAX_BATCH_SIZE"], key),
                 )
+        return items
+
+    def put_many(self):
+        """Apply per-device changes, reporting a status for each item.
+
+        Body is {"devices": [{"_id": ..., "name": ..., ...}, ...]}. One
+        query finds which of the devices exist and belong to the user,
+        then devices with the same changes are updated together in one
+        multi update.
+        """
+        items = self.get_batch("devices")
+        user_id = get_user_id_or_abort()
+
+        parsed = []
+        for item in items:
+            if not isinstance(item, dict):
+                item = {}
+            device_id = item.pop("_id", None)
+            changes = dict((key, value) for key, value in item.iteritems() if value)
+            parsed.append((device_id, parse_object_id(device_id), changes))
+        wanted = [oid for _, oid, _ in parsed if oid]
+        owned = set(d["_id"] for d in Device.find(
+                {"_id": {"$in": wanted}, "resource_owner_id": user_id}, ["_id"]))
+
+        statuses, groups = [], {}
+        for device_id, oid, changes in parsed:
+            if oid is None or oid not in owned:
+                statuses.append((device_id, None, "not_found"))
+            elif not changes or \
+                    not set(changes) <= set(self.batch_fields) or \
+                    not all(isinstance(v, basestring) for v in changes.values()):
+                statuses.append((device_id, None, "invalid"))
+            else:
+                statuses.append((device_id, oid, "updated"))
+                groups.setdefault(frozenset(changes.items()), []).append(oid)
+
+        now = datetime.utcnow()
+        for changes, oids in groups.iteritems():
+            document = dict(changes)
+            document["updated_since"] = now
+            Device.modify({"_id": {"$in": oids}}, {"$set": document}, multi=True)
+
+        return jsonify({
+                "flag": "success",
+                "res": [{
+                        "_id": device_id,
+                        "status": status,
+                        } for device_id, oid, status in statuses],
+                })
+
+    def get_many(self, ids):
+        """The user's devices among ids, keyed by id, null if not found.
+
+        All of them are read with one $in query on the user's devices.
+        """
+        ids = self.get_batch("ids", ids)
+        args = list_parser.parse_args()
+        try:
+            fields = select_fields(device_fields, args["fields"])
+        except ValueError as e:
+            raise ApiException(code=400, msg=str(e))
+
+        user_id = get_user_id_or_abort()
+        wanted = set(parse_object_id(i) for i in ids) - set([None])
+
+        marshaller = cached_marshaller(fields)
+        found = dict((device["_id"], marshaller(device)) for device in
+                     Device.find({"_id": {"$in": list(wanted)},
+                                  "resource_owner_id": user_id}, fields.keys()))
+        # keyed as the caller spelled the ids, "ABC..." finds "abc..."
+        return jsonify({
+                "flag": "success",
+                "res": dict((unicode(i), found.get(parse_object_id(i)))
+                            for i in ids),
+                })
+
+    def post(self, device_id):
+        """Multi-id lookup with the ids in the body, for large sets."""
+        return self.get_many(None)
+
+    def put(self, device_id):
+        if device_id is None:
+            return self.put_many()
         elif device_id == "from_access_token":
-            device = get_device_or_abort()
+            device = Device.load(get_device_or_abort())
         else:
-            device = Device.find_one({'_id': ObjectId(device_id)})
+            device = Device.load(Device.find_one({'_id': ObjectId(device_id)}))
             if not device:
                 raise ApiException(
                     code=404,
@@ -130,43 +250,123 @@ class DeviceList(MethodView):
         if args["model"]:
             device["model"] = args["model"]
         device["updated_since"] = datetime.utcnow()
-        Device.save(device)
+        Device.save(device, check_version=True)
 
         return jsonify({
                 "flag": "success",
-                "res": marshal(device, device_fields),
+                "res": marshal_device(device),
                 })
 
+    def get_page(self, user_id):
+        """Keyset paginated devices of a user, newest first.
+
+        Returns (find, fields, limit, next_url), where find(projection)
+        queries the page and next_url builds the link to the page after
+        a given device.
+        """
+        args = list_parser.parse_args()
+        try:
+            fields = select_fields(device_fields, args["fields"])
+            position = decode_cursor(args["cursor"]) if args["cursor"] else None
+        except ValueError as e:
+            raise ApiException(code=400, msg=str(e))
+
+        limit = args["limit"] or current_app.config["DEVICES_PAGE_SIZE"]
+        limit = max(1, min(limit, current_app.config["DEVICES_MAX_PAGE_SIZE"]))
+
+        spec = {'resource_owner_id': user_id}
+        if position:
+            updated_since, oid = position
+            spec['$or'] = [
+                {'updated_since': {'$lt': updated_since}},
+                {'updated_since': updated_since, '_id': {'$lt': oid}},
+                ]
+        def find(projection):
+            # one extra document tells whether there is a next page
+            return Device \
+                .find(spec, projection) \
+                .sort([('updated_since', -1), ('_id', -1)]) \
+                .limit(limit + 1) \
+                .batch_size(min(limit + 1, 100))
+
+        def next_url(last):
+            return url_for(".devices",
+                           cursor=encode_cursor(last),
+                           limit=limit,
+                           fields=args["fields"],
+                           _external=True)
+        return find, fields, limit, next_url
+
     def get(self, device_id):
-        if device_id is None:
-            user = get_user_or_abort()
-            devices = Device \
-                .find({'_id': {'$in': [oid for oid in user.device_ids]}}) \
-                .sort('updated_since', -1)
-            devices_marshaled = []
-            for device in devices:
-                devices_marshaled.append(marshal(device, device_fields))
-            return jsonify({
-                    "flag": "success",
-                    "res": devices_marshaled,
-                    })
+        if device_id is None and request.args.get("ids"):
+            return self.get_many([i.strip() for i in request.args["ids"].split(",")])
+        elif device_id is None:
+            find, fields, limit, next_url = self.get_page(get_user_id_or_abort())
+
+            # validate against the timestamps of the page only
+            stamps = list(find(['updated_since']))
+            etag = make_etag(request.query_string,
+                             [(d['_id'], d['updated_since']) for d in stamps])
+            last_modified = stamps[0]['updated_since'] if stamps else None
+            response = not_modified(etag, last_modified)
+            if response:
+                return response
+
+            # updated_since is always read, the next cursor is built from it
+            devices = find(list(set(fields) | set(['updated_since'])))
+            marshaller = cached_marshaller(fields)
+            response = Response(
+                stream_with_context(
+                    stream_page(devices, limit, marshaller, next_url)),
+                mimetype="application/json")
+            return add_validators(response, etag, last_modified)
         elif device_id == "from_access_token":
+            stamp = get_device_or_abort(['updated_since'])
+            etag = make_etag(stamp['_id'], stamp['updated_since'])
+            response = not_modified(etag, stamp['updated_since'])
+            if response:
+                return response
             device = get_device_or_abort()
-            return jsonify({
-                    "flag": "success",
-                    "res": marshal(device, device_fields),
-                    })
         else:
+            stamp = Device.find_one({'_id': ObjectId(device_id)},
+                                    ['updated_since'])
+            if not stamp:
+                raise ApiException(
+                    code=404,
+                    msg="Device {} doesn't exist".format(device_id),
+                    )
+            etag = make_etag(stamp['_id'], stamp['updated_since'])
+            response = not_modified(etag, stamp['updated_since'])
+            if response:
+                return response
             device = Device.find_one({'_id': ObjectId(device_id)})
             if not device:
+                # removed since the projection was read
                 raise ApiException(
                     code=404,
                     msg="Device {} doesn't exist".format(device_id),
                     )
-            return jsonify({
-                    "flag": "success",
-                    "res": marshal(device, device_fields),
-                    })
+
+        # the document may have changed since the projection was read
+        response = jsonify({
+                "flag": "success",
+                "res": marshal_device(device),
+                })
+        return add_validators(response,
+                              make_etag(device['_id'], device['updated_since']),
+                              device['updated_since'])
+
+
+class AccessTokenRevocation(MethodView):
+
+    decorators = [require_oauth]
+
+    def delete(self):
+        """Revoke the access token the request is signed with."""
+        revoke_access_token(get_access_token_or_abort())
+        return jsonify({
+                "flag": "success",
+                })
 
 
 api.add_url_rule("/v1/seeds",
@@ -176,7 +376,7 @@ device_list_view = DeviceList.as_view("devices")
 api.add_url_rule("/v1/devices",
                  defaults={"device_id": None},
                  view_func=device_list_view,
-                 methods=["GET",])
+                 methods=["GET", "PUT", "POST"])
 api.add_url_rule("/v1/devices/<string:device_id>",
                  view_func=device_list_view,
                  methods=["GET", "PUT"])
@@ -188,3 +388,7 @@ api.add_url_rule("/v1/device",
 api.add_url_rule("/v1/me",
                  view_func=Myself.as_view("myself"),
                  methods=["GET", "PUT"])
+
+api.add_url_rule("/v1/access_token",
+                 view_func=AccessTokenRevocation.as_view("access_token"),
+                 methods=["DELETE"])
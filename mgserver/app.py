@@ -1,20 +1,41 @@
 import difflib
 from functools import wraps
 import re
-from flask import Flask, request, make_response, current_app
+import time
+from flask import Flask, request, make_response, current_app, g, Response
 from flask.ext.restful.utils import error_data
 from bson.objectid import ObjectId
+from pymongo.errors import ConnectionFailure, OperationFailure
 from .configs import DevConfig
-from .frontend import frontend
+from .frontend import frontend, fragment_cache
 from .api import api
-from .extensions import provider, login_manager, bcrypt, totp
-from .database import ResourceOwner as User
+from .extensions import provider, login_manager, bcrypt, hasher, totp, mongo
+from .extensions import secrets_cache, nonce_store, metrics, query_profiler
+from .extensions import signed_tokens
+from .database import ResourceOwner as User, clear_identity_map
+from .database import find_user
+from .database import ensure_indexes, IndexConflict
 
 
 # For import *
 __all__ = ['create_app']
 
 
+request_seconds = metrics.histogram(
+    "mgserver_request_seconds",
+    "Request latency, by endpoint, method and status.",
+    ["endpoint", "method", "status"])
+phase_seconds = metrics.histogram(
+    "mgserver_request_phase_seconds",
+    "Time a request spent in oauth validation, mongo and the rest (app).",
+    ["endpoint", "phase"])
+mongo_calls = metrics.histogram(
+    "mgserver_request_mongo_operations",
+    "Mongo operations made by a request.",
+    ["endpoint"],
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64))
+
+
 DEFAULT_BLUEPRINTS = (
     frontend,
     api,
@@ -34,6 +55,8 @@ def create_app(config=None, app_name=None, blueprints=None):
     configure_hook(app)
     configure_blueprints(app, blueprints)
     configure_extensions(app)
+    configure_metrics(app)
+    configure_indexes(app)
     configure_template_filters(app)
 
     return app
@@ -52,7 +75,34 @@ def configure_app(app, config):
 def configure_hook(app):
     @app.before_request
     def before_request():
-        pass
+        g.request_started = time.time()
+        clear_identity_map()
+        query_profiler.begin()
+
+    @app.after_request
+    def after_request(response):
+        g.response_status = response.status_code
+        clear_identity_map()
+        return query_profiler.add_headers(response)
+
+    @app.teardown_request
+    def teardown_request(exception):
+        # runs once a streamed response has been sent as well
+        query_profiler.end()
+        if not metrics.enabled or not hasattr(g, "request_started"):
+            return
+        elapsed = time.time() - g.request_started
+        endpoint = request.endpoint or "unknown"
+        status = getattr(g, "response_status", 500)
+        request_seconds.observe(elapsed, endpoint, request.method, status)
+
+        phases = metrics.phases()
+        spent = 0.0
+        for phase, (seconds, calls) in phases.iteritems():
+            phase_seconds.observe(seconds, endpoint, phase)
+            spent += seconds
+        phase_seconds.observe(max(elapsed - spent, 0.0), endpoint, "app")
+        mongo_calls.observe(phases.get("mongo", (0.0, 0))[1], endpoint)
 
 
 def configure_blueprints(app, blueprints):
@@ -63,8 +113,25 @@ def configure_blueprints(app, blueprints):
 
 
 def configure_extensions(app):
+    # pooled mongo connection, one client per process
+    mongo.init_app(app)
+
+    # cross-request cache of oauth clients and tokens
+    secrets_cache.init_app(app)
+
+    # rendered frontend fragments
+    fragment_cache.init_app(app)
+
+    # oauth replay protection
+    nonce_store.init_app(app)
+    signed_tokens.init_app(app)
+
+    # per-request query log, see QUERY_PROFILER
+    query_profiler.init_app(app)
+
     # flask-bcrypt
     bcrypt.init_app(app)
+    hasher.init_app(app)
 
     # flask-oauthprovider
     provider.init_app(app)
@@ -74,13 +141,7 @@ def configure_extensions(app):
 
     @login_manager.user_loader
     def load_user(userid):
-        user_dict = User.find_one({'_id': ObjectId(userid)})
-        if user_dict:
-            user = User()
-            user.update(user_dict)
-            return user
-        else:
-            return None
+        return User.load(find_user(ObjectId(userid)))
 
     login_manager.setup_app(app)
 
@@ -88,6 +149,40 @@ def configure_extensions(app):
     totp.init_app(app)
 
 
+def configure_metrics(app):
+    """Expose the metrics on /metrics, unless METRICS_ENABLED is off."""
+
+    metrics.init_app(app)
+    if not app.config["METRICS_ENABLED"]:
+        return
+
+    @app.route("/metrics")
+    def expose_metrics():
+        return Response(metrics.render(),
+                        mimetype="text/plain; version=0.0.4")
+
+
+def configure_indexes(app):
+    """Build missing indexes in the background, instead of in the request paths.
+
+    Indexes that need rebuilding are only reported, the app still has to
+    start for manage.py create_indexes to rebuild them.
+    """
+
+    if not app.config["MONGO_ENSURE_INDEXES"]:
+        return
+
+    try:
+        with app.app_context():
+            ensure_indexes(background=True)
+    except ConnectionFailure as e:
+        app.logger.warning("Indexes not built, mongo unreachable: %s", e)
+    except (IndexConflict, OperationFailure) as e:
+        app.logger.error("Indexes not built: %s", e)
+    # don't hand the startup connection down to forked workers
+    mongo.reset()
+
+
 def configure_template_filters(app):
 
     @app.template_filter()
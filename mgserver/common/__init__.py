@@ -1 +1,4 @@
 from .exceptions import ApiException, SignupException, CreateClientException
+from .exceptions import HasherBusyException, ConflictException
+from .cache import Cache
+from .metrics import Metrics
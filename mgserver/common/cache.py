@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import OrderedDict
+from copy import deepcopy
+
+
+class NullCache(object):
+    """Backend that never stores anything."""
+
+    def __init__(self, threshold=0, default_timeout=0):
+        pass
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def __len__(self):
+        return 0
+
+
+class SimpleCache(object):
+    """In-process LRU cache whose entries also expire after a timeout."""
+
+    def __init__(self, threshold=500, default_timeout=60):
+        self.threshold = threshold
+        self.default_timeout = default_timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            # re-insert to mark as most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + timeout, value)
+            while len(self._entries) > self.threshold:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Cache(object):
+    """Cache extension whose backend is picked by the CACHE_TYPE setting.
+
+    Values are copied on the way in and out, so cached documents can be
+    handed to callers that modify them.
+    """
+
+    backends = {
+        "null": NullCache,
+        "simple": SimpleCache,
+        }
+
+    def __init__(self, app=None):
+        self.backend = NullCache()
+        self.cache_type = "null"
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.cache_type = app.config["CACHE_TYPE"]
+        try:
+            backend_class = self.backends[self.cache_type]
+        except KeyError:
+            raise ValueError("Unknown CACHE_TYPE: {}".format(self.cache_type))
+        self.backend = backend_class(
+            threshold=app.config["CACHE_THRESHOLD"],
+            default_timeout=app.config["CACHE_DEFAULT_TIMEOUT"],
+            )
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return deepcopy(value)
+
+    def set(self, key, value, timeout=None):
+        self.backend.set(key, deepcopy(value), timeout)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return {
+            "type": self.cache_type,
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.backend),
+            }
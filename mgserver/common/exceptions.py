@@ -4,6 +4,22 @@ class ApiException(Exception):
         self.msg = msg
 
 
+class HasherBusyException(ApiException):
+    def __init__(self):
+        super(HasherBusyException, self).__init__(
+            code=503,
+            msg="Too many password checks in progress, try again later",
+            )
+
+
+class ConflictException(ApiException):
+    def __init__(self, _id):
+        super(ConflictException, self).__init__(
+            code=409,
+            msg="{} was modified by another request, reload and retry".format(_id),
+            )
+
+
 class CreateClientException(Exception):
     def __init__(self, name):
         self.name = name
@@ -0,0 +1,164 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_request_context
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace('"', '\\"'))
+                             for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter(object):
+    """Monotonic count, one series per combination of label values."""
+
+    kind = "counter"
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *values):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def value(self, *values):
+        return self._values.get(values, 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for values, count in items:
+            yield self.name, _format_labels(self.labels, values), count
+
+
+class Histogram(object):
+    """Observations counted into cumulative buckets, plus their sum."""
+
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, amount, *values):
+        index = bisect.bisect_left(self.buckets, amount)
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = [[0] * len(self.buckets), 0.0]
+            series[0][index] += 1
+            series[1] += amount
+
+    def count(self, *values):
+        series = self._series.get(values)
+        return sum(series[0]) if series else 0
+
+    def sum(self, *values):
+        series = self._series.get(values)
+        return series[1] if series else 0.0
+
+    def samples(self):
+        with self._lock:
+            items = sorted((values, (list(counts), total))
+                           for values, (counts, total) in self._series.items())
+        for values, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield (self.name + "_bucket",
+                       _format_labels(self.labels, values,
+                                      [("le", _format_value(bound))]),
+                       cumulative)
+            yield self.name + "_sum", _format_labels(self.labels, values), total
+            yield self.name + "_count", _format_labels(self.labels, values), cumulative
+
+
+class Metrics(object):
+    """Registry of counters and histograms, exposed by METRICS_ENABLED.
+
+    Metrics are declared at import time by the modules that record them.
+    While disabled, timed() and add_phase() do nothing, so instrumented
+    code costs a flag check.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self._metrics = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config["METRICS_ENABLED"]
+
+    def counter(self, name, doc, labels=()):
+        metric = Counter(name, doc, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, doc, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    @contextmanager
+    def timed(self, histogram, *values):
+        """Observe the time spent in the block into histogram."""
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            histogram.observe(time.time() - start, *values)
+
+    def add_phase(self, phase, seconds, calls=1):
+        """Charge seconds and calls to a phase of the current request."""
+        if not self.enabled or not has_request_context():
+            return
+        phases = getattr(g, "metrics_phases", None)
+        if phases is None:
+            phases = g.metrics_phases = {}
+        spent, count = phases.get(phase, (0.0, 0))
+        phases[phase] = (spent + seconds, count + calls)
+
+    def phases(self):
+        """(seconds, calls) per phase charged in the current request."""
+        if not has_request_context():
+            return {}
+        return getattr(g, "metrics_phases", {})
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.doc))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append("%s%s %s" % (name, labels, _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
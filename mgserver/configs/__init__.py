@@ -1 +1 @@
-from .config import BaseConfig, DevConfig, TestConfig
+from .config import BaseConfig, DevConfig, TestConfig, AsyncConfig
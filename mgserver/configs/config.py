@@ -16,9 +16,64 @@ class BaseConfig(object):
     # os.urandom(24)
     SECRET_KEY = 'secret key'
 
+    # "mongo", or "memory" for the in-process engine (single node only)
+    STORAGE_ENGINE = "mongo"
+
     MONGO_HOST = "localhost"
     MONGO_PORT = 27017
     MONGO_DATABASE = "mgserver_oauth_provider"
+    MONGO_MAX_POOL_SIZE = 10
+    MONGO_CONNECT_TIMEOUT_MS = 2000
+    MONGO_SOCKET_TIMEOUT_MS = 5000
+    MONGO_READ_PREFERENCE = "PRIMARY" # any name in pymongo.ReadPreference
+    MONGO_ENSURE_INDEXES = True # build declared indexes in create_app
+    MONGO_USE_GREENLETS = False # pool sockets per greenlet, for gevent
+
+    # Cache for OAuth clients and access tokens, "simple" or "null"
+    CACHE_TYPE = "simple"
+    CACHE_DEFAULT_TIMEOUT = 60
+    CACHE_THRESHOLD = 1000
+    USER_CACHE_TIMEOUT = 10 # frontend users, other nodes' writes show this late
+    FRAGMENT_CACHE_TIMEOUT = 600 # rendered frontend lists, keyed by data version
+
+    # OAuth nonces, "mongo" or "memory" (single node only)
+    NONCE_STORE = "mongo"
+    NONCE_TIMESTAMP_WINDOW = 600 # seconds
+
+    # token lifetimes in seconds, expired tokens are dropped by TTL indexes
+    REQUEST_TOKEN_LIFETIME = 3600
+    ACCESS_TOKEN_LIFETIME = 90 * 24 * 3600
+
+    # manage.py sweep_tokens, see mgserver.database.sweeper
+    SWEEPER_BATCH_SIZE = 500
+    SWEEPER_INTERVAL = 3600 # seconds between passes with --loop
+
+    # self-contained access tokens, validated without reading the database,
+    # see SignedTokens. ACCESS_TOKEN_KEY falls back to SECRET_KEY
+    SIGNED_ACCESS_TOKENS = False
+    ACCESS_TOKEN_KEY = None
+    TOKEN_REVOCATION_SYNC = 30 # seconds between reloads of revoked tokens
+
+    # bcrypt runs on a bounded thread pool, see MGPasswordHasher
+    BCRYPT_LOG_ROUNDS = 12
+    PASSWORD_HASH_WORKERS = 2
+    PASSWORD_HASH_QUEUE_DEPTH = 8
+
+    # GET /v1/devices pagination
+    DEVICES_PAGE_SIZE = 100
+    DEVICES_MAX_PAGE_SIZE = 1000
+    # most devices a single batch request may name
+    DEVICES_MAX_BATCH_SIZE = 1000
+
+    # request, oauth and mongo timings, exposed on /metrics
+    METRICS_ENABLED = True
+
+    # log every mongo call of a request, all requests or, with DEBUG or
+    # TESTING, those sending the header
+    QUERY_PROFILER = False
+    QUERY_PROFILER_HEADER = "X-Profile-Queries"
+    QUERY_PROFILER_THRESHOLD = 20 # warn above this many queries
+    QUERY_PROFILER_SLOW_MS = 100
 
     DUMMY_EMAIL = "dummy@example.com"
     DUMMY_PASSWORD = "dummyhash321"
@@ -57,10 +112,27 @@ class DevConfig(BaseConfig):
     DEFAULT_MAIL_SENDER = '%s@gmail.com' % MAIL_USERNAME
 
 
+class AsyncConfig(BaseConfig):
+
+    # ===========================================
+    # async_server.py, the API on gevent
+    #
+    MONGO_USE_GREENLETS = True
+    MONGO_MAX_POOL_SIZE = 100
+    ASYNC_HOST = "0.0.0.0"
+    ASYNC_PORT = 5001
+    ASYNC_MAX_CONNECTIONS = 10000
+
+
 class TestConfig(BaseConfig):
 
     TESTING = True
 
     CSRF_ENABLED = False
 
+    # no mongod needed, MGSERVER_TEST_STORAGE=mongo runs against one
+    STORAGE_ENGINE = os.environ.get("MGSERVER_TEST_STORAGE", "memory")
     MONGO_DATABASE = "mgserver_unittest"
+    MONGO_ENSURE_INDEXES = False # tests build them after dropping the db
+
+    BCRYPT_LOG_ROUNDS = 4
@@ -1,6 +1,19 @@
+from .connection import MongoConnection
 from .models import ResourceOwner, Client, Device
 from .models import Nonce, RequestToken, AccessToken
+from .models import RevokedToken
+from .models import clear_identity_map
+from .indexes import ensure_indexes, index_report, IndexConflict
+from .sweeper import sweep
+from .migrations import migrate_ownership
+from .lookup import secrets_cache, find_user, invalidate_user
+from .nonce import nonce_store
+from .tokens import signed_tokens
+from .profiler import query_profiler
 from .provider import MongoProvider
 from .helper import get_or_create_device
 from .helper import get_user_or_abort, get_client_or_abort, get_device_or_abort
+from .helper import get_user_id_or_abort, get_access_token_or_abort
 from .helper import create_user, create_client
+from .helper import revoke_access_token
+from .helper import owned_ids, with_owned_ids
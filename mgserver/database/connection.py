@@ -0,0 +1,100 @@
+import os
+import threading
+from flask import current_app
+import pymongo
+from .memory import MemoryClient
+
+
+class MongoConnection(object):
+    """One pooled MongoClient per process, shared by every request.
+
+    The client is created lazily on first use and re-created when the
+    process id changes, so pre-forking WSGI servers never share sockets
+    inherited from the master process. STORAGE_ENGINE "memory" swaps the
+    MongoClient for the in-process MemoryClient.
+    """
+
+    client_class = pymongo.MongoClient
+    engines = ("mongo", "memory")
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._client = None
+        self._pid = None
+        self._clients_created = 0
+        self._settings = {}
+        self.engine = "mongo"
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.engine = app.config["STORAGE_ENGINE"]
+        if self.engine not in self.engines:
+            raise ValueError("Unknown STORAGE_ENGINE: {}".format(self.engine))
+        self._settings = {
+            "host": app.config["MONGO_HOST"],
+            "port": app.config["MONGO_PORT"],
+            "database": app.config["MONGO_DATABASE"],
+            "max_pool_size": app.config["MONGO_MAX_POOL_SIZE"],
+            "connectTimeoutMS": app.config["MONGO_CONNECT_TIMEOUT_MS"],
+            "socketTimeoutMS": app.config["MONGO_SOCKET_TIMEOUT_MS"],
+            "read_preference": getattr(pymongo.ReadPreference,
+                                       app.config["MONGO_READ_PREFERENCE"]),
+            "use_greenlets": app.config["MONGO_USE_GREENLETS"],
+            }
+        app.extensions["mongo"] = self
+        self.reset()
+
+    @property
+    def client(self):
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    self._client = self._connect()
+                    self._pid = os.getpid()
+                    self._clients_created += 1
+        return self._client
+
+    @property
+    def db(self):
+        return self.client[self._settings["database"]]
+
+    def _connect(self):
+        settings = self._settings
+        client_class = MemoryClient if self.engine == "memory" else self.client_class
+        return client_class(
+            settings["host"],
+            settings["port"],
+            max_pool_size=settings["max_pool_size"],
+            connectTimeoutMS=settings["connectTimeoutMS"],
+            socketTimeoutMS=settings["socketTimeoutMS"],
+            read_preference=settings["read_preference"],
+            use_greenlets=settings["use_greenlets"],
+            )
+
+    def reset(self):
+        """Drop the current client; the next access reconnects."""
+        with self._lock:
+            client, self._client, self._pid = self._client, None, None
+        if client is not None:
+            client.close()
+
+    def stats(self):
+        client = self._client if self._pid == os.getpid() else None
+        # private in pymongo, so tolerate clients that do not have it
+        sockets = getattr(getattr(client, "_MongoClient__pool", None),
+                          "sockets", None)
+        return {
+            "pid": os.getpid(),
+            "engine": self.engine,
+            "connected": client is not None,
+            "clients_created": self._clients_created,
+            "max_pool_size": self._settings.get("max_pool_size"),
+            "idle_sockets": len(sockets) if isinstance(sockets, set) else 0,
+            "host": self._settings.get("host"),
+            "port": self._settings.get("port"),
+            }
+
+
+def get_db():
+    return current_app.extensions["mongo"].db
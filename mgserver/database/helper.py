@@ -1,6 +1,10 @@
-from flask import request, current_app
+from datetime import datetime
+from pymongo.errors import DuplicateKeyError
+from flask import request, current_app, g
 from ..common import ApiException, CreateClientException, SignupException
 from .models import ResourceOwner as User, Client, Device, AccessToken
+from .lookup import invalidate_client, invalidate_access_token, invalidate_user
+from .tokens import signed_tokens
 
 
 def create_user(email, passwd="", name=""):
@@ -8,13 +12,11 @@ def create_user(email, passwd="", name=""):
     if user:
         raise SignupException('This email address is already signed up')
 
-    User.ensure_index("email")
-
     # HACK: this is for avoiding recursive import
-    from ..extensions import bcrypt
+    from ..extensions import hasher
     user_dict = {
         u"email": email,
-        u"pw_hash": bcrypt.generate_password_hash(passwd),
+        u"pw_hash": hasher.generate(passwd),
         u"name": name,
         }
     user = User(**user_dict)
@@ -28,11 +30,6 @@ def create_client(user, name, description, callback):
     if client:
         raise CreateClientException(name)
 
-    Client.ensure_index([("resource_owner_id", 1), ("created_at", -1)])
-    Client.ensure_index([("resource_owner_id", 1), ("name", 1)])
-    Client.ensure_index("client_key")
-    Client.ensure_index("name")
-
     # HACK: this is for avoiding recursive import
     from ..extensions import provider
     client_dict = {
@@ -45,53 +42,128 @@ def create_client(user, name, description, callback):
         }
     client = Client(**client_dict)
     Client.save(client)
+    invalidate_client(client["client_key"])
 
-    # save back to user
-    user["client_ids"].append(client["_id"])
+    # the user's client_ids in /v1/me changed
+    user["updated_since"] = datetime.utcnow()
     User.save(user)
+    invalidate_user(user["_id"])
 
     return client
 
 
 def get_or_create_device(access_token):
+    # the common case, one read on the unique access_token_id index
     device = Device.find_one({"access_token_id": access_token["_id"]})
-    if not device:
-        user = User.find_one({"_id": access_token["resource_owner_id"]})
-        if not user:
+    if device:
+        return device
+
+    defaults = dict(Device(access_token["_id"],
+                           resource_owner_id=access_token["resource_owner_id"]))
+    del defaults["access_token_id"]
+    try:
+        device = Device.find_and_modify(
+            {"access_token_id": access_token["_id"]},
+            {"$setOnInsert": defaults},
+            upsert=True,
+            new=True,
+            )
+    except DuplicateKeyError:
+        # another request created it between the upsert's read and write
+        device = Device.find_one({"access_token_id": access_token["_id"]})
+
+    # the user's device_ids in /v1/me changed
+    result = User.modify(
+        {"_id": access_token["resource_owner_id"]},
+        {"$set": {"updated_since": datetime.utcnow()}},
+        )
+    if result and not result["n"]:
+        # don't leave a device that the find_one above would hand out next time
+        Device.remove({"_id": device["_id"]})
+        raise ApiException(
+            code=404,
+            msg="User not associated with access token",
+            )
+    return device
+
+
+def owned_ids(user_id, seed_client_ids=()):
+    """client_ids and device_ids of a user, found by resource_owner_id.
+
+    seed_client_ids, the clients the user was seeded for, are client_ids too.
+    """
+    client_ids = set(client["_id"] for client in
+                     Client.find({"resource_owner_id": user_id}, ["_id"]))
+    client_ids.update(seed_client_ids)
+    device_ids = [device["_id"] for device in
+                  Device.find({"resource_owner_id": user_id}, ["_id"])]
+    return {
+        "client_ids": sorted(client_ids),
+        "device_ids": sorted(device_ids),
+        }
+
+
+def with_owned_ids(user):
+    """A copy of user with client_ids and device_ids, as /v1/me shows it."""
+    user = dict(user)
+    user.update(owned_ids(user["_id"], user.get("seed_client_ids", ())))
+    return user
+
+
+def get_access_token_or_abort(code=404):
+    """The access token the request is signed with.
+
+    MongoProvider.validate_access_token leaves it on g, so this only
+    queries when the provider did not resolve it.
+    """
+    access_token = request.oauth.resource_owner_key
+    token = getattr(g, "oauth_token", None)
+    if token is None or token["token"] != access_token:
+        token = AccessToken.find_one({'token': access_token})
+        if not token:
             raise ApiException(
-                code=404,
-                msg="User not associated with access token",
+                code=code,
+                msg="Access token doesn't associate with any user",
                 )
+        g.oauth_token = token
+    return token
 
-        Device.ensure_index("access_token_id")
-        Device.ensure_index("created_at")
-        Device.ensure_index("updated_since")
-        Device.ensure_index("name")
 
-        device_dict = {"access_token_id": access_token["_id"]}
-        device = Device(**device_dict)
-        Device.save(device)
+def revoke_access_token(token):
+    """Stop accepting an access token.
 
-        # save back to user instance
-        user["device_ids"].append(device["_id"])
-        User.save(user)
-    return device
+    A signed token is also added to the revoked tokens, as validating it
+    never reads its document.
+    """
+    AccessToken.remove({'_id': token['_id']})
+    invalidate_access_token(token['token'], token['client_id'])
+    claims = signed_tokens.verify(token['token'])
+    if claims:
+        signed_tokens.revoke(claims)
+
+
+def get_user_id_or_abort():
+    """Id of the user owning the access token, without loading the user."""
+    if "TESTING_WITHOUT_OAUTH" in current_app.config:
+        return current_app.config["TESTING_WITHOUT_OAUTH"]["known_user"]["_id"]
+
+    return get_access_token_or_abort(code=401)['resource_owner_id']
 
 
 def get_user_or_abort():
     if "TESTING_WITHOUT_OAUTH" in current_app.config:
         return current_app.config["TESTING_WITHOUT_OAUTH"]["known_user"]
 
-    access_token = request.oauth.resource_owner_key
-    token = AccessToken.find_one({'token': access_token})
-    if not token:
-        raise ApiException(
-            code=401,
-            msg="Access token doesn't associate with any user",
-            )
-    user_dict = User.find_one({'_id': token['resource_owner_id']})
-    user = User()
-    user.update(user_dict)
+    user = getattr(g, "oauth_user", None)
+    if user is None:
+        user_id = get_user_id_or_abort()
+        user = User.load(User.find_one({'_id': user_id}))
+        if not user:
+            raise ApiException(
+                code=404,
+                msg="User {} doesn't exist".format(user_id),
+                )
+        g.oauth_user = user
     return user
 
 
@@ -99,31 +171,33 @@ def get_client_or_abort():
     if "TESTING_WITHOUT_OAUTH" in current_app.config:
         return current_app.config["TESTING_WITHOUT_OAUTH"]["known_client"]
 
-    access_token = request.oauth.resource_owner_key
-    token = AccessToken.find_one({'token': access_token})
-    if not token:
-        raise ApiException(
-            code=404,
-            msg="Access token doesn't associate with any user",
-            )
-    client = Client.find_one({"_id": token["client_id"]})
-    if not client:
-        raise ApiException(
-            code=404,
-            msg="Access token doesn't associate with any client",
-            )
+    token = get_access_token_or_abort()
+    client = getattr(g, "oauth_client", None)
+    if client is None or client["_id"] != token["client_id"]:
+        client = Client.find_one({"_id": token["client_id"]})
+        if not client:
+            raise ApiException(
+                code=404,
+                msg="Access token doesn't associate with any client",
+                )
+        g.oauth_client = client
     return client
 
 
-def get_device_or_abort():
+def get_device_or_abort(fields=None):
+    """The device of the request's access token, created if missing.
+
+    With fields, an existing device is only read with that projection.
+    """
     if "TESTING_WITHOUT_OAUTH" in current_app.config:
         return current_app.config["TESTING_WITHOUT_OAUTH"]["known_device"]
 
-    access_token = request.oauth.resource_owner_key
-    token = AccessToken.find_one({'token': access_token})
-    if not token:
-        raise ApiException(
-            code=404,
-            msg="Access token doesn't associate with any user",
-            )
-    return get_or_create_device(token)
+    device = getattr(g, "oauth_device", None)
+    if device is None and fields is not None:
+        device = Device.find_one(
+            {"access_token_id": get_access_token_or_abort()["_id"]}, fields)
+        if device:
+            return device
+    if device is None:
+        device = g.oauth_device = get_or_create_device(get_access_token_or_abort())
+    return device
@@ -0,0 +1,98 @@
+import logging
+from pymongo.errors import OperationFailure
+from .models import Model
+
+
+logger = logging.getLogger(__name__)
+
+
+def registered_models():
+    """Every Model subclass that is backed by a collection."""
+    models, pending = [], list(Model.__subclasses__())
+    while pending:
+        model = pending.pop(0)
+        pending.extend(model.__subclasses__())
+        if getattr(model, "table", None):
+            models.append(model)
+    return models
+
+
+class IndexConflict(Exception):
+    """A declared index exists on the server with other options."""
+
+
+def _changed(index, info):
+    return any(info.get(option) != value
+               for option, value in index.options.iteritems()
+               if option != "name")
+
+
+def _rebuild(collection, index, info, options):
+    """Replace an index by its declared version, keep the old one on failure."""
+    collection.drop_index(index.name)
+    try:
+        collection.create_index(index.keys, **options)
+    except OperationFailure:
+        old = dict((key, value) for key, value in info.iteritems()
+                   if key not in ("key", "v", "ns", "name"))
+        collection.create_index(info["key"], name=index.name, **old)
+        raise
+
+
+def ensure_indexes(rebuild=False, background=False):
+    """Build the missing indexes every model declares, return their names.
+
+    A declared index the server has with other options, e.g. one made
+    unique since it was first built, is dropped and built again with
+    rebuild, otherwise IndexConflict is raised. Build failures are raised
+    as they are, uniqueness must not silently go missing.
+    """
+    created = []
+    for model in registered_models():
+        collection = model.get_collection()
+        existing = collection.index_information()
+        for index in model.indexes:
+            options = dict(index.options, name=index.name)
+            if background:
+                options["background"] = True
+            info = existing.get(index.name)
+            if info is None:
+                collection.create_index(index.keys, **options)
+            elif not _changed(index, info):
+                continue
+            elif rebuild:
+                logger.warning("Rebuilding index %s on %s", index.name, model.table)
+                _rebuild(collection, index, info, options)
+            else:
+                raise IndexConflict(
+                    "Index %s on %s differs from its declaration, "
+                    "run manage.py create_indexes" % (index.name, model.table))
+            created.append("%s.%s" % (model.table, index.name))
+    return created
+
+
+def index_report():
+    """Compare declared indexes with the ones present in the database.
+
+    Returns {table: {"missing": [...], "unused": [...], "changed": [...]}},
+    where unused lists indexes no model declares and changed lists the
+    declared ones whose options differ from what the server has.
+    """
+    report = {}
+    for model in registered_models():
+        existing = model.get_collection().index_information()
+        declared = dict((index.name, index) for index in model.indexes)
+
+        missing = sorted(name for name in declared if name not in existing)
+        unused = sorted(name for name in existing
+                        if name not in declared and name != "_id_")
+        changed = sorted(
+            name for name, index in declared.iteritems()
+            if name in existing and _changed(index, existing[name]))
+
+        report[model.table] = {
+            "missing": missing,
+            "unused": unused,
+            "changed": changed,
+            }
+    return report
@@ -0,0 +1,57 @@
+from datetime import datetime
+from flask import current_app
+from ..common import Cache
+from .models import ResourceOwner as User, Client, AccessToken
+
+
+# Clients and access tokens are read by every signed request but
+# almost never change, so keep them around across requests. Users
+# logged in to the frontend are kept for USER_CACHE_TIMEOUT only.
+secrets_cache = Cache()
+
+
+def find_client_by_key(client_key):
+    key = ("client", client_key)
+    client = secrets_cache.get(key)
+    if client is None:
+        client = Client.find_one({'client_key': client_key})
+        if client:
+            secrets_cache.set(key, client)
+    return client
+
+
+def find_access_token(token, client_id):
+    key = ("access_token", token, client_id)
+    access_token = secrets_cache.get(key)
+    if access_token is None:
+        access_token = AccessToken.find_one(
+            {'token': token, 'client_id': client_id})
+        if access_token:
+            secrets_cache.set(key, access_token)
+    # the TTL index drops expired tokens only once a minute
+    if access_token and access_token.get('expires_at') and \
+            access_token['expires_at'] < datetime.utcnow():
+        return None
+    return access_token
+
+
+def find_user(user_id):
+    key = ("user", user_id)
+    user = secrets_cache.get(key)
+    if user is None:
+        user = User.find_one({'_id': user_id})
+        if user:
+            secrets_cache.set(key, user, current_app.config["USER_CACHE_TIMEOUT"])
+    return user
+
+
+def invalidate_client(client_key):
+    secrets_cache.delete(("client", client_key))
+
+
+def invalidate_access_token(token, client_id):
+    secrets_cache.delete(("access_token", token, client_id))
+
+
+def invalidate_user(user_id):
+    secrets_cache.delete(("user", user_id))
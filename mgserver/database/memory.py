@@ -0,0 +1,491 @@
+"""In-process storage engine, selected with STORAGE_ENGINE = "memory".
+
+MemoryClient stands in for pymongo.MongoClient and implements the part of
+the client, database, collection and cursor API that Model and the
+indexes module use: equality (including array membership), $in, $nin,
+$ne, $lt/$lte/$gt/$gte, $exists, $or and $and queries, projections,
+sort/skip/limit, the $set, $unset, $inc, $push, $addToSet, $pull and
+$setOnInsert updates, unique and TTL indexes. Documents live in process
+memory and are copied on the way in and out, so the engine suits tests,
+benchmarks and single-node deployments only.
+"""
+import threading
+import time
+from collections import OrderedDict
+from copy import deepcopy
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+
+def _lookup(doc, key):
+    """(found, value) of a possibly dotted key."""
+    value = doc
+    for part in key.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return False, None
+        value = value[part]
+    return True, value
+
+
+def _equals(found, value, expected):
+    if not found:
+        return expected is None
+    if value == expected:
+        return True
+    return isinstance(value, list) and expected in value
+
+
+def _compare(predicate):
+    def compare(found, value, arg):
+        if not found or value is None:
+            return False
+        values = value if isinstance(value, list) else [value]
+        return any(predicate(v, arg) for v in values if v is not None)
+    return compare
+
+
+def _in(found, value, arg):
+    return any(_equals(found, value, expected) for expected in arg)
+
+
+_OPERATORS = {
+    "$in": _in,
+    "$nin": lambda found, value, arg: not _in(found, value, arg),
+    "$ne": lambda found, value, arg: not _equals(found, value, arg),
+    "$lt": _compare(lambda v, arg: v < arg),
+    "$lte": _compare(lambda v, arg: v <= arg),
+    "$gt": _compare(lambda v, arg: v > arg),
+    "$gte": _compare(lambda v, arg: v >= arg),
+    "$exists": lambda found, value, arg: found == bool(arg),
+    "$all": lambda found, value, arg: all(_equals(found, value, x) for x in arg),
+    }
+
+
+def _is_operator_dict(value):
+    return isinstance(value, dict) and value and \
+        all(key.startswith("$") for key in value)
+
+
+def matches(doc, spec):
+    """True if doc satisfies the query spec."""
+    for key, condition in spec.iteritems():
+        if key == "$or":
+            if not any(matches(doc, sub) for sub in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(doc, sub) for sub in condition):
+                return False
+        else:
+            found, value = _lookup(doc, key)
+            if _is_operator_dict(condition):
+                for op, arg in condition.iteritems():
+                    try:
+                        operator = _OPERATORS[op]
+                    except KeyError:
+                        raise OperationFailure("Unsupported operator: %s" % op)
+                    if not operator(found, value, arg):
+                        return False
+            elif not _equals(found, value, condition):
+                return False
+    return True
+
+
+def project(doc, fields):
+    """Copy of doc restricted to fields, a list of names or a dict."""
+    if fields is None:
+        return deepcopy(doc)
+    if isinstance(fields, dict):
+        included = [key for key, value in fields.iteritems() if value]
+        excluded = [key for key, value in fields.iteritems() if not value]
+        if not included:
+            return deepcopy(dict((k, v) for k, v in doc.iteritems()
+                                 if k not in excluded))
+        with_id = fields.get("_id", True)
+    else:
+        included, with_id = list(fields), True
+    result = {}
+    if with_id and "_id" in doc:
+        result["_id"] = doc["_id"]
+    for key in included:
+        if key in doc:
+            result[key] = deepcopy(doc[key])
+    return result
+
+
+def _set(doc, key, value):
+    parts = key.split(".")
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _each(value):
+    if isinstance(value, dict) and "$each" in value:
+        return list(value["$each"])
+    return [value]
+
+
+def apply_update(doc, update, inserting=False):
+    """Return doc changed by an update document, a replacement or operators."""
+    if not any(key.startswith("$") for key in update):
+        replacement = deepcopy(update)
+        replacement["_id"] = doc["_id"]
+        return replacement
+
+    doc = deepcopy(doc)
+    for op, changes in update.iteritems():
+        for key, value in changes.iteritems():
+            value = deepcopy(value)
+            if op == "$set" or (op == "$setOnInsert" and inserting):
+                _set(doc, key, value)
+            elif op == "$setOnInsert":
+                pass
+            elif op == "$unset":
+                doc.pop(key, None)
+            elif op == "$inc":
+                _set(doc, key, (_lookup(doc, key)[1] or 0) + value)
+            elif op == "$push":
+                doc.setdefault(key, []).extend(_each(value))
+            elif op == "$addToSet":
+                items = doc.setdefault(key, [])
+                items.extend(v for v in _each(value) if v not in items)
+            elif op == "$pull":
+                doc[key] = [v for v in doc.get(key, [])
+                            if not (matches({"v": v}, {"v": value}))]
+            else:
+                raise OperationFailure("Unsupported update operator: %s" % op)
+    return doc
+
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.iteritems()))
+    if isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    return value
+
+
+def _normalize_keys(key_or_list, direction=None):
+    if isinstance(key_or_list, basestring):
+        return [(key_or_list, direction or 1)]
+    return [tuple(key) for key in key_or_list]
+
+
+class MemoryCursor(object):
+    """Lazily evaluated result of MemoryCollection.find."""
+
+    def __init__(self, collection, spec, fields):
+        self._collection = collection
+        self._spec = spec or {}
+        self._fields = fields
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._results = None
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = _normalize_keys(key_or_list, direction)
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def hint(self, index):
+        return self
+
+    def _documents(self):
+        docs = self._collection._select(self._spec)
+        if self._sort:
+            for key, direction in reversed(self._sort):
+                docs.sort(key=lambda doc: _lookup(doc, key)[1],
+                          reverse=direction < 0)
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return docs
+
+    def count(self, with_limit_and_skip=False):
+        if with_limit_and_skip:
+            return len(self._documents())
+        return len(self._collection._select(self._spec))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._results is None:
+            self._results = iter([project(doc, self._fields)
+                                  for doc in self._documents()])
+        return next(self._results)
+
+
+class MemoryCollection(object):
+
+    def __init__(self, name):
+        self.name = name
+        self._docs = OrderedDict()
+        self._indexes = OrderedDict()
+        # unique index name -> {key values: _id}
+        self._unique = {}
+        self._lock = threading.RLock()
+        self._expired_at = 0
+
+    # indexes
+
+    def create_index(self, key_or_list, **kwargs):
+        keys = _normalize_keys(key_or_list)
+        name = kwargs.pop("name", None) or \
+            "_".join("%s_%s" % key for key in keys)
+        kwargs.pop("background", None)
+        with self._lock:
+            self._indexes[name] = dict(kwargs, key=keys)
+            if kwargs.get("unique"):
+                entries = {}
+                for doc in self._docs.itervalues():
+                    value = self._index_value(keys, doc)
+                    if value in entries:
+                        del self._indexes[name]
+                        raise DuplicateKeyError(
+                            "E11000 duplicate key error index: %s" % name)
+                    entries[value] = doc["_id"]
+                self._unique[name] = entries
+        return name
+
+    ensure_index = create_index
+
+    def index_information(self):
+        info = {"_id_": {"key": [("_id", 1)]}}
+        for name, index in self._indexes.iteritems():
+            info[name] = dict(index)
+        return info
+
+    def drop_index(self, name):
+        with self._lock:
+            self._indexes.pop(name, None)
+            self._unique.pop(name, None)
+
+    def _index_value(self, keys, doc):
+        return tuple(_hashable(_lookup(doc, key)[1]) for key, _ in keys)
+
+    def _expire(self):
+        """Remove documents past a TTL index, at most once a second."""
+        now = time.time()
+        if now - self._expired_at < 1:
+            return
+        self._expired_at = now
+        for index in self._indexes.values():
+            if "expireAfterSeconds" not in index:
+                continue
+            key = index["key"][0][0]
+            cutoff = datetime.utcnow() - \
+                timedelta(seconds=index["expireAfterSeconds"])
+            for doc in self._docs.values():
+                value = _lookup(doc, key)[1]
+                if isinstance(value, datetime) and value < cutoff:
+                    self._unstore(doc)
+
+    # storage, all called with the lock held
+
+    def _store(self, doc, old=None):
+        for name, entries in self._unique.iteritems():
+            value = self._index_value(self._indexes[name]["key"], doc)
+            owner = entries.get(value)
+            if owner is not None and owner != doc["_id"]:
+                raise DuplicateKeyError(
+                    "E11000 duplicate key error index: %s.%s dup key: %r"
+                    % (self.name, name, value))
+        if old is None and doc["_id"] in self._docs:
+            raise DuplicateKeyError(
+                "E11000 duplicate key error index: %s._id_" % self.name)
+        if old is not None:
+            self._unstore(old)
+        for name, entries in self._unique.iteritems():
+            entries[self._index_value(self._indexes[name]["key"], doc)] = doc["_id"]
+        self._docs[doc["_id"]] = doc
+
+    def _unstore(self, doc):
+        for name, entries in self._unique.iteritems():
+            entries.pop(self._index_value(self._indexes[name]["key"], doc), None)
+        self._docs.pop(doc["_id"], None)
+
+    def _select(self, spec):
+        """Stored documents matching spec, using _id or a unique index
+        for plain equality queries."""
+        with self._lock:
+            self._expire()
+            if "_id" in spec and not isinstance(spec["_id"], dict):
+                doc = self._docs.get(spec["_id"])
+                return [doc] if doc is not None and matches(doc, spec) else []
+            if spec and not any(key.startswith("$") or isinstance(value, (dict, list))
+                                for key, value in spec.iteritems()):
+                for name, entries in self._unique.iteritems():
+                    keys = self._indexes[name]["key"]
+                    if set(key for key, _ in keys) == set(spec):
+                        _id = entries.get(tuple(_hashable(spec[key])
+                                                for key, _ in keys))
+                        doc = self._docs.get(_id)
+                        return [doc] if doc is not None and matches(doc, spec) else []
+            return [doc for doc in self._docs.itervalues() if matches(doc, spec)]
+
+    # queries
+
+    def find(self, spec=None, fields=None, **kwargs):
+        cursor = MemoryCursor(self, spec, fields)
+        if kwargs.get("sort"):
+            cursor.sort(kwargs["sort"])
+        return cursor.skip(kwargs.get("skip", 0)).limit(kwargs.get("limit", 0))
+
+    def find_one(self, spec_or_id=None, fields=None, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {"_id": spec_or_id}
+        for doc in self.find(spec_or_id, fields, **kwargs).limit(1):
+            return doc
+        return None
+
+    def count(self):
+        return len(self._select({}))
+
+    # writes
+
+    def insert(self, doc_or_docs, **kwargs):
+        docs = doc_or_docs if isinstance(doc_or_docs, list) else [doc_or_docs]
+        with self._lock:
+            for doc in docs:
+                if "_id" not in doc:
+                    doc["_id"] = ObjectId()
+                self._store(deepcopy(dict(doc)))
+        ids = [doc["_id"] for doc in docs]
+        return ids if isinstance(doc_or_docs, list) else ids[0]
+
+    def save(self, doc, **kwargs):
+        if "_id" not in doc:
+            return self.insert(doc)
+        with self._lock:
+            old = self._docs.get(doc["_id"])
+            self._store(deepcopy(dict(doc)), old)
+        return doc["_id"]
+
+    def _upsert(self, spec, document):
+        doc = dict((key, deepcopy(value)) for key, value in spec.iteritems()
+                   if not key.startswith("$") and not _is_operator_dict(value))
+        doc.setdefault("_id", ObjectId())
+        doc = apply_update(doc, document, inserting=True)
+        self._store(doc)
+        return doc
+
+    def update(self, spec, document, upsert=False, multi=False, **kwargs):
+        with self._lock:
+            docs = self._select(spec)
+            if not multi:
+                docs = docs[:1]
+            for old in docs:
+                self._store(apply_update(old, document), old)
+            if docs or not upsert:
+                return {"n": len(docs), "updatedExisting": bool(docs),
+                        "err": None, "ok": 1.0}
+            doc = self._upsert(spec, document)
+            return {"n": 1, "updatedExisting": False, "upserted": doc["_id"],
+                    "err": None, "ok": 1.0}
+
+    def find_and_modify(self, query=None, update=None, upsert=False, sort=None,
+                        new=False, fields=None, remove=False, **kwargs):
+        query = query or {}
+        with self._lock:
+            cursor = MemoryCursor(self, query, None).limit(1)
+            if sort:
+                cursor.sort(sort.items() if isinstance(sort, dict) else sort)
+            docs = cursor._documents()
+            if remove:
+                if docs:
+                    self._unstore(docs[0])
+                    return project(docs[0], fields)
+                return None
+            if docs:
+                old = docs[0]
+                doc = apply_update(old, update)
+                self._store(doc, old)
+                return project(doc if new else old, fields)
+            if upsert:
+                doc = self._upsert(query, update)
+                return project(doc, fields) if new else None
+            return None
+
+    def remove(self, spec_or_id=None, multi=True, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {"_id": spec_or_id}
+        with self._lock:
+            docs = self._select(spec_or_id or {})
+            if not multi:
+                docs = docs[:1]
+            for doc in docs:
+                self._unstore(doc)
+        return {"n": len(docs), "err": None, "ok": 1.0}
+
+
+class MemoryDatabase(object):
+
+    def __init__(self, name):
+        self.name = name
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        collection = self._collections.get(name)
+        if collection is None:
+            with self._lock:
+                collection = self._collections.setdefault(
+                    name, MemoryCollection(name))
+        return collection
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def collection_names(self):
+        return self._collections.keys()
+
+    def drop_collection(self, name):
+        self._collections.pop(name, None)
+
+
+class MemoryClient(object):
+    """Client of the process-wide in-memory databases.
+
+    Connection settings are accepted and ignored, and every client of a
+    process sees the same data, so MongoConnection.reset loses nothing.
+    """
+
+    _databases = {}
+    _lock = threading.Lock()
+
+    def __init__(self, host=None, port=None, **kwargs):
+        pass
+
+    def __getitem__(self, name):
+        with self._lock:
+            database = self._databases.get(name)
+            if database is None:
+                database = self._databases[name] = MemoryDatabase(name)
+        return database
+
+    def database_names(self):
+        return self._databases.keys()
+
+    def drop_database(self, name):
+        with self._lock:
+            self._databases.pop(getattr(name, "name", name), None)
+
+    def close(self):
+        pass
+
+    disconnect = close
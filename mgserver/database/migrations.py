@@ -0,0 +1,59 @@
+import logging
+from .models import ResourceOwner as User, Client, Device, AccessToken
+
+
+logger = logging.getLogger(__name__)
+
+
+def migrate_ownership(batch_size=500):
+    """Move device ownership from users' device_ids to Device.resource_owner_id.
+
+    Devices left without an owner take it from their access token, users'
+    client_ids are kept as seed_client_ids, then the embedded id arrays
+    are dropped from users and clients. Safe to run again. Returns the
+    counts of what was changed.
+    """
+    counts = {"devices": 0, "users": 0, "clients": 0}
+    users = User.find({"device_ids": {"$exists": True}}, ["device_ids"])
+    for user in users.batch_size(batch_size):
+        if not user["device_ids"]:
+            continue
+        result = Device.modify(
+            {"_id": {"$in": user["device_ids"]}, "resource_owner_id": None},
+            {"$set": {"resource_owner_id": user["_id"]}},
+            multi=True)
+        counts["devices"] += result["n"] if result else 0
+
+    orphans = Device.find({"resource_owner_id": None}, ["access_token_id"])
+    for device in orphans.batch_size(batch_size):
+        token = AccessToken.find_one({"_id": device["access_token_id"]},
+                                     ["resource_owner_id"])
+        if token:
+            Device.modify({"_id": device["_id"]},
+                          {"$set": {"resource_owner_id": token["resource_owner_id"]}})
+            counts["devices"] += 1
+
+    # seeded users have no other link to their client
+    users = User.find({"client_ids": {"$exists": True, "$ne": []}},
+                      ["client_ids"])
+    for user in users.batch_size(batch_size):
+        User.modify({"_id": user["_id"]},
+                    {"$addToSet": {"seed_client_ids":
+                                   {"$each": user["client_ids"]}}})
+
+    result = User.modify(
+        {"$or": [{key: {"$exists": True}} for key in
+                 ("client_ids", "device_ids", "request_tokens", "access_tokens")]},
+        {"$unset": {"client_ids": 1, "device_ids": 1,
+                    "request_tokens": 1, "access_tokens": 1}},
+        multi=True)
+    counts["users"] = result["n"] if result else 0
+    result = Client.modify(
+        {"$or": [{key: {"$exists": True}} for key in
+                 ("request_tokens", "access_tokens")]},
+        {"$unset": {"request_tokens": 1, "access_tokens": 1}},
+        multi=True)
+    counts["clients"] = result["n"] if result else 0
+
+    logger.info("ownership migrated %s", counts)
+    return counts
@@ -1,43 +1,284 @@
-from flask import current_app
-import pymongo
+from contextlib import contextmanager
+from copy import deepcopy
 from datetime import datetime
+import time
 import uuid
+from bson import BSON
+from flask import g, has_request_context
+from ..common import ConflictException
+from ..common.metrics import metrics
+from .connection import get_db
+from .profiler import query_profiler
+
+
+mongo_seconds = metrics.histogram(
+    "mgserver_mongo_operation_seconds",
+    "Mongo round-trips made through Model, by collection and operation.",
+    ["collection", "operation"])
+
+mongo_written_bytes = metrics.counter(
+    "mgserver_mongo_written_bytes_total",
+    "Encoded size of the documents and changes Model.save wrote.",
+    ["kind"])
+
+
+def _timing():
+    return metrics.enabled or query_profiler.active()
+
+
+@contextmanager
+def _operation(table, name, spec=None):
+    """Time a mongo call into the metrics and the query profile."""
+    if not _timing():
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        if metrics.enabled:
+            mongo_seconds.observe(elapsed, table, name)
+            metrics.add_phase("mongo", elapsed)
+        if query_profiler.active():
+            query_profiler.record(table, name, spec, elapsed)
+
+
+class _TimedCursor(object):
+    """Cursor whose iteration is charged to the mongo phase.
+
+    The query is sent with the first batch, so the first next() is what
+    gets observed as the find; later batches only count as mongo time.
+    """
+
+    chainable = ("sort", "limit", "skip", "batch_size", "hint")
+
+    def __init__(self, cursor, table, spec):
+        self._cursor = cursor
+        self._table = table
+        self._spec = spec
+        self._started = False
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if name not in self.chainable:
+            return attr
+        def chain(*args, **kwargs):
+            attr(*args, **kwargs)
+            return self
+        return chain
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if not self._started:
+            self._started = True
+            with _operation(self._table, "find", self._spec):
+                return self._cursor.next()
+        start = time.time()
+        try:
+            return self._cursor.next()
+        finally:
+            metrics.add_phase("mongo", time.time() - start, calls=0)
+
+
+# documents written by Model.save, and their encoded size
+write_stats = {"full": 0, "partial": 0, "bytes": 0}
+
+
+def _count_write(kind, document):
+    write_stats[kind] += 1
+    # sizing takes a second BSON encode, only pay for it when it is reported
+    if not metrics.enabled:
+        return
+    size = len(BSON.encode(document))
+    write_stats["bytes"] += size
+    mongo_written_bytes.inc(size, kind)
+
+
+def _identity_map():
+    """Return the find_one cache of the current request, if any."""
+    if not has_request_context():
+        return None
+    if not hasattr(g, "identity_map"):
+        g.identity_map = {}
+    return g.identity_map
+
+
+def clear_identity_map():
+    if has_request_context():
+        g.identity_map = {}
+
+
+def _freeze(value):
+    """Turn a query into something hashable, independent of key order."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class Index(object):
+    """An index a model needs, built by ensure_indexes at startup."""
+
+    def __init__(self, keys, **options):
+        if isinstance(keys, basestring):
+            keys = [(keys, 1)]
+        self.keys = keys
+        self.options = options
+        self.name = options.get("name") or "_".join("%s_%s" % key for key in keys)
 
-
-def get_db():
-    connection = pymongo.MongoClient(current_app.config['MONGO_HOST'],
-                                     current_app.config['MONGO_PORT'])
-    return connection[current_app.config['MONGO_DATABASE']]
+    def __repr__(self):
+        return "<Index (%s, %s)>" % (self.name, self.options)
 
 
 class Model(dict):
+    indexes = []
+
     @classmethod
     def get_collection(cls):
         db = get_db()
         return db[cls.table]
 
     @classmethod
-    def find_one(cls, attrs):
-        return cls.get_collection().find_one(attrs)
+    def find_one(cls, attrs, fields=None):
+        identity_map = _identity_map()
+        if identity_map is None:
+            with _operation(cls.table, "find_one", attrs):
+                return cls.get_collection().find_one(attrs, fields)
+
+        key = (_freeze(attrs), _freeze(fields))
+        entries = identity_map.setdefault(cls.table, {})
+        if key not in entries:
+            with _operation(cls.table, "find_one", attrs):
+                entries[key] = cls.get_collection().find_one(attrs, fields)
+        # hand out copies, callers are free to modify what they get
+        return deepcopy(entries[key])
 
     @classmethod
-    def find(cls, attrs):
-        return cls.get_collection().find(attrs)
+    def find(cls, attrs, fields=None):
+        cursor = cls.get_collection().find(attrs, fields)
+        if _timing():
+            return _TimedCursor(cursor, cls.table, attrs)
+        return cursor
 
     @classmethod
     def insert(cls, obj):
-        return cls.get_collection().insert(obj)
+        cls.invalidate()
+        with _operation(cls.table, "insert"):
+            return cls.get_collection().insert(obj)
+
+    @classmethod
+    def load(cls, doc):
+        """Wrap a fetched document so that save() only writes what changed."""
+        if doc is None:
+            return None
+        obj = cls.__new__(cls)
+        dict.update(obj, doc)
+        obj.mark_clean()
+        return obj
+
+    @classmethod
+    def save(cls, obj, check_version=False):
+        """Write obj, as $set/$push of its changes when obj was loaded.
+
+        With check_version, a loaded document is only written if its
+        updated_since is still the one it was loaded with, otherwise
+        ConflictException is raised.
+        """
+        cls.invalidate()
+        changes = obj.changes() if isinstance(obj, Model) else None
+        if changes is None or '_id' not in obj:
+            _count_write("full", obj)
+            with _operation(cls.table, "save", {'_id': obj.get('_id')}):
+                result = cls.get_collection().save(obj)
+            if isinstance(obj, Model):
+                obj.mark_clean()
+            return result
+
+        if changes:
+            spec = {'_id': obj['_id']}
+            if check_version:
+                spec['updated_since'] = obj._version
+            _count_write("partial", changes)
+            with _operation(cls.table, "update", spec):
+                result = cls.get_collection().update(spec, changes)
+            if check_version and result and not result['n']:
+                raise ConflictException(obj['_id'])
+            obj.mark_clean()
+        return obj['_id']
+
+    @classmethod
+    def modify(cls, spec, document, **kwargs):
+        """Collection.update, named so it won't shadow dict.update."""
+        cls.invalidate()
+        with _operation(cls.table, "update", spec):
+            return cls.get_collection().update(spec, document, **kwargs)
+
+    @classmethod
+    def find_and_modify(cls, spec, document, **kwargs):
+        cls.invalidate()
+        with _operation(cls.table, "find_and_modify", spec):
+            return cls.get_collection().find_and_modify(spec, document, **kwargs)
 
     @classmethod
-    def save(cls, obj):
-        return cls.get_collection().save(obj)
+    def remove(cls, spec):
+        cls.invalidate()
+        with _operation(cls.table, "remove", spec):
+            return cls.get_collection().remove(spec)
 
     @classmethod
-    def ensure_index(cls, key_or_list):
-        return cls.get_collection().ensure_index(key_or_list)
+    def ensure_index(cls, key_or_list, **kwargs):
+        return cls.get_collection().ensure_index(key_or_list, **kwargs)
+
+    @classmethod
+    def invalidate(cls):
+        """Forget every cached find_one of this collection."""
+        identity_map = _identity_map()
+        if identity_map is not None:
+            identity_map.pop(cls.table, None)
+
+    def mark_clean(self):
+        """Start tracking changes from the current state."""
+        self.__dict__['_dirty'] = set()
+        self.__dict__['_pushed'] = {}
+        self.__dict__['_version'] = self.get('updated_since')
+
+    def changes(self):
+        """Update document for what changed since load, None if untracked."""
+        dirty = self.__dict__.get('_dirty')
+        if dirty is None:
+            return None
+        changes = {}
+        if dirty:
+            changes['$set'] = dict((key, self[key]) for key in dirty)
+        if self._pushed:
+            changes['$push'] = dict((key, {'$each': values})
+                                    for key, values in self._pushed.iteritems())
+        return changes
+
+    def push(self, key, value):
+        """Append value to the list at key, saved as a $push."""
+        self.setdefault(key, []).append(value)
+        pushed = self.__dict__.get('_pushed')
+        if pushed is not None and key not in self._dirty:
+            pushed.setdefault(key, []).append(value)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        dirty = self.__dict__.get('_dirty')
+        if dirty is not None and key != '_id':
+            dirty.add(key)
+            # the $set carries the whole list now
+            self._pushed.pop(key, None)
 
     def __getattr__(self, attr):
-        return self[attr]
+        try:
+            return self[attr]
+        except KeyError:
+            raise AttributeError(attr)
 
     def __setattr__(self, attr, value):
         self[attr] = value
@@ -45,6 +286,9 @@ class Model(dict):
 
 class ResourceOwner(Model):
     table = "users"
+    indexes = [
+        Index("email"),
+        ]
 
     def __init__(self, name="", email="", pw_hash=""):
         now = datetime.utcnow()
@@ -56,11 +300,6 @@ class ResourceOwner(Model):
         self.created_at = now
         self.updated_since = now
 
-        self.request_tokens = []
-        self.access_tokens = []
-        self.client_ids = []
-        self.device_ids = []
-
     def __repr__(self):
         return "<ResourceOwner (%s, %s)>" % (self.name, self.email)
 
@@ -79,6 +318,12 @@ class ResourceOwner(Model):
 
 class Client(Model):
     table = "clients"
+    indexes = [
+        Index("client_key", unique=True),
+        Index([("resource_owner_id", 1), ("created_at", -1)]),
+        Index([("resource_owner_id", 1), ("name", 1)]),
+        Index("name"),
+        ]
 
     def __init__(self, client_key, secret, callbacks, resource_owner_id, name, description):
         now = datetime.utcnow()
@@ -91,8 +336,6 @@ class Client(Model):
 
         self.client_key = client_key
         self.secret = secret
-        self.request_tokens = []
-        self.access_tokens = []
         self.callbacks = callbacks
         self.resource_owner_id = resource_owner_id
 
@@ -102,12 +345,20 @@ class Client(Model):
 
 class Device(Model):
     table = "devices"
+    indexes = [
+        Index("access_token_id", unique=True),
+        Index("created_at"),
+        Index("updated_since"),
+        Index([("resource_owner_id", 1), ("updated_since", -1), ("_id", -1)]),
+        Index("name"),
+        ]
 
     def __init__(self,
                  access_token_id,
                  vendor="", model="",
                  features=[],
-                 name="", description=""):
+                 name="", description="",
+                 resource_owner_id=None):
         now = datetime.utcnow()
 
         self.name = name
@@ -116,6 +367,7 @@ class Device(Model):
         self.model = model
         self.features = []
         self.access_token_id = access_token_id
+        self.resource_owner_id = resource_owner_id
 
         self.mgserver_id = uuid.uuid4()
         self.created_at = now
@@ -127,22 +379,32 @@ class Device(Model):
 
 class Nonce(Model):
     table = "nonces"
+    indexes = [
+        Index([("client_key", 1), ("nonce", 1), ("timestamp", 1)], unique=True),
+        Index("expires_at", expireAfterSeconds=0),
+        ]
 
-    def __init__(self, nonce, timestamp):
+    def __init__(self, nonce, timestamp, client_key, expires_at):
         self.nonce = nonce
         self.timestamp = timestamp
-        self.client_id = ""
-        self.request_token_id = ""
-        self.access_token_id = ""
+        self.client_key = client_key
+        self.request_token = None
+        self.access_token = None
+        self.expires_at = expires_at
 
     def __repr__(self):
-        return "<Nonce (%s, %s, %s, %s)>" % (self.nonce, self.timestamp, self.client, self.resource_owner)
+        return "<Nonce (%s, %s, %s)>" % (self.nonce, self.timestamp, self.client_key)
 
 
 class RequestToken(Model):
     table = "requestTokens"
+    indexes = [
+        Index("token", unique=True),
+        Index("expires_at", expireAfterSeconds=0),
+        ]
 
-    def __init__(self, token, callback, secret=None, verifier=None, realm=None):
+    def __init__(self, token, callback, secret=None, verifier=None, realm=None,
+                 expires_at=None):
         self.token = token
         self.secret = secret
         self.verifier = verifier
@@ -150,6 +412,7 @@ class RequestToken(Model):
         self.callback = callback
         self.client_id = ""
         self.resource_owner_id = ""
+        self.expires_at = expires_at
 
 
     def __repr__(self):
@@ -158,14 +421,34 @@ class RequestToken(Model):
 
 class AccessToken(Model):
     table = "accessTokens"
+    indexes = [
+        Index("token", unique=True),
+        Index("expires_at", expireAfterSeconds=0),
+        ]
 
-    def __init__(self, token, secret=None, verifier=None, realm=None):
+    def __init__(self, token, secret=None, verifier=None, realm=None,
+                 expires_at=None):
         self.token = token
         self.secret = secret
         self.verifier = verifier
         self.realm = realm
         self.client_id = ""
         self.resource_owner_id = ""
+        self.expires_at = expires_at
 
     def __repr__(self):
         return "<AccessToken (%s, %s, %s)>" % (self.token, self.client, self.resource_owner)
+
+
+class RevokedToken(Model):
+    table = "revokedTokens"
+    indexes = [
+        Index("expires_at", expireAfterSeconds=0),
+        ]
+
+    def __init__(self, token_id, expires_at):
+        self._id = token_id
+        self.expires_at = expires_at
+
+    def __repr__(self):
+        return "<RevokedToken (%s)>" % self._id
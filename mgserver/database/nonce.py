@@ -0,0 +1,99 @@
+import heapq
+import threading
+import time
+from datetime import datetime
+from pymongo.errors import DuplicateKeyError
+from .models import Nonce
+
+
+class MongoNonceStore(object):
+    """Nonces kept in the nonces collection.
+
+    The unique index Nonce declares on (client_key, nonce, timestamp) turns
+    the replay check into a single insert, and its TTL index drops nonces
+    once their timestamp has left the window.
+    """
+
+    def add(self, client_key, nonce, timestamp, expires,
+            request_token=None, access_token=None):
+        doc = Nonce(nonce, timestamp, client_key,
+                    datetime.utcfromtimestamp(expires))
+        doc.request_token = request_token
+        doc.access_token = access_token
+        try:
+            Nonce.insert(doc)
+        except DuplicateKeyError:
+            return False
+        return True
+
+
+class MemoryNonceStore(object):
+    """Nonces kept in process memory, only correct on a single node."""
+
+    def __init__(self):
+        self._expiry = {}
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def add(self, client_key, nonce, timestamp, expires,
+            request_token=None, access_token=None):
+        key = (client_key, nonce, timestamp)
+        now = time.time()
+        with self._lock:
+            while self._heap and self._heap[0][0] < now:
+                expired, old_key = heapq.heappop(self._heap)
+                if self._expiry.get(old_key) == expired:
+                    del self._expiry[old_key]
+            if key in self._expiry:
+                return False
+            self._expiry[key] = expires
+            heapq.heappush(self._heap, (expires, key))
+        return True
+
+    def __len__(self):
+        return len(self._expiry)
+
+
+class NonceStore(object):
+    """Replay protection for OAuth requests.
+
+    A nonce is accepted once, and only if its timestamp lies within
+    NONCE_TIMESTAMP_WINDOW seconds of the server clock. NONCE_STORE picks
+    the backend, "mongo" or "memory".
+    """
+
+    backends = {
+        "mongo": MongoNonceStore,
+        "memory": MemoryNonceStore,
+        }
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.window = 600
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        store = app.config["NONCE_STORE"]
+        try:
+            self.backend = self.backends[store]()
+        except KeyError:
+            raise ValueError("Unknown NONCE_STORE: {}".format(store))
+        self.window = app.config["NONCE_TIMESTAMP_WINDOW"]
+
+    def check_and_add(self, client_key, timestamp, nonce,
+                      request_token=None, access_token=None):
+        """Return True if the nonce is fresh, remembering it as used."""
+        try:
+            ts = int(timestamp)
+        except (TypeError, ValueError):
+            return False
+        if abs(time.time() - ts) > self.window:
+            return False
+
+        return self.backend.add(client_key, nonce, timestamp, ts + self.window,
+                                request_token=request_token,
+                                access_token=access_token)
+
+
+nonce_store = NonceStore()
@@ -0,0 +1,117 @@
+import os
+import traceback
+from collections import Counter
+from flask import g, request, has_request_context
+
+
+_here = os.path.dirname(os.path.abspath(__file__))
+_package = os.path.dirname(_here)
+# frames of the model layer itself are never the call site
+_skipped = tuple(os.path.join(_here, name) for name in ("models.py", "profiler.py"))
+
+
+def query_shape(spec):
+    """The spec with its values blanked, so equal queries look equal."""
+    if isinstance(spec, dict):
+        return dict((key, query_shape(value) if key.startswith("$") or
+                     isinstance(value, dict) else "?")
+                    for key, value in spec.iteritems())
+    if isinstance(spec, (list, tuple)):
+        return [query_shape(value) for value in spec[:1]]
+    return "?"
+
+
+def call_site():
+    """file:line of the innermost caller in mgserver above the model layer."""
+    for filename, lineno, function, _ in reversed(traceback.extract_stack()):
+        filename = os.path.abspath(filename)
+        if filename.startswith(_package) and not filename.startswith(_skipped):
+            return "{}:{} in {}".format(
+                os.path.relpath(filename, os.path.dirname(_package)),
+                lineno, function)
+    return "?"
+
+
+class QueryProfiler(object):
+    """Record every mongo call of a request made through Model.
+
+    QUERY_PROFILER profiles all requests; outside production (DEBUG or
+    TESTING) a request can also ask for it with the QUERY_PROFILER_HEADER
+    header. The query count and time go to X-Query-Count/X-Query-Time
+    response headers, and a summary is logged when the request ends,
+    as a warning if it made more than QUERY_PROFILER_THRESHOLD queries or
+    any took longer than QUERY_PROFILER_SLOW_MS.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.always = app.config["QUERY_PROFILER"]
+        self.header = app.config["QUERY_PROFILER_HEADER"]
+        self.threshold = app.config["QUERY_PROFILER_THRESHOLD"]
+        self.slow = app.config["QUERY_PROFILER_SLOW_MS"] / 1000.0
+        self.allow_header = app.debug or app.testing
+
+    def active(self):
+        return has_request_context() and \
+            getattr(g, "query_profile", None) is not None
+
+    def begin(self):
+        """Start profiling the current request, if asked to."""
+        if self.app is None:
+            return
+        if self.always or \
+                (self.allow_header and request.headers.get(self.header)):
+            g.query_profile = []
+
+    def record(self, table, operation, spec, seconds):
+        g.query_profile.append({
+                "collection": table,
+                "operation": operation,
+                "shape": query_shape(spec),
+                "seconds": seconds,
+                "site": call_site(),
+                })
+
+    def add_headers(self, response):
+        if self.active():
+            queries = g.query_profile
+            response.headers["X-Query-Count"] = str(len(queries))
+            response.headers["X-Query-Time"] = "%.1fms" % (
+                sum(q["seconds"] for q in queries) * 1000)
+        return response
+
+    def summary(self, queries):
+        """Queries grouped by collection, operation, shape and call site,
+        the most repeated first."""
+        groups = Counter(
+            (q["collection"], q["operation"], repr(q["shape"]), q["site"])
+            for q in queries)
+        return groups.most_common()
+
+    def end(self):
+        """Log what the request queried."""
+        if not self.active():
+            return
+        queries, g.query_profile = g.query_profile, None
+        slow = [q for q in queries if q["seconds"] > self.slow]
+        flagged = len(queries) > self.threshold or slow
+
+        lines = ["%dx %s.%s %s at %s" % (count, table, operation, shape, site)
+                 for (table, operation, shape, site), count in self.summary(queries)]
+        lines.extend("slow %.1fms %s.%s %s at %s" % (
+                q["seconds"] * 1000, q["collection"], q["operation"],
+                q["shape"], q["site"]) for q in slow)
+
+        log = self.app.logger.warning if flagged else self.app.logger.info
+        log("%s %s made %d queries in %.1fms\n  %s",
+            request.method, request.path, len(queries),
+            sum(q["seconds"] for q in queries) * 1000,
+            "\n  ".join(lines))
+
+
+query_profiler = QueryProfiler()
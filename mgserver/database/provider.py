@@ -1,12 +1,59 @@
-from flask import request, render_template, g, url_for, redirect
+from functools import wraps
+import time
+from datetime import datetime, timedelta
+from flask import request, render_template, g, url_for, redirect, current_app
+from flask import abort
 from flask.ext.oauthprovider import OAuthProvider
+from oauthlib.common import generate_token, urlencode
 from flask.ext.login import current_user
 from bson.objectid import ObjectId
+from ..common.metrics import metrics
 from .helper import get_or_create_device
-from .models import ResourceOwner as User, Client, Nonce
+from .lookup import find_client_by_key, find_access_token
+from .lookup import invalidate_access_token
+from .nonce import nonce_store
+from .tokens import signed_tokens
+from .models import ResourceOwner as User, Client
 from .models import RequestToken, AccessToken
 
 
+oauth_seconds = metrics.histogram(
+    "mgserver_oauth_provider_seconds",
+    "Time spent in the provider's validate_ and get_ methods.",
+    ["method"])
+
+
+def _timed(name, method):
+    @wraps(method)
+    def timed(*args, **kwargs):
+        if not metrics.enabled:
+            return method(*args, **kwargs)
+        mongo_before = metrics.phases().get("mongo", (0.0, 0))[0]
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            oauth_seconds.observe(elapsed, name)
+            # mongo calls made while validating are already charged to mongo
+            mongo = metrics.phases().get("mongo", (0.0, 0))[0] - mongo_before
+            metrics.add_phase("oauth", elapsed - mongo)
+    return timed
+
+
+def _expiry(lifetime):
+    return datetime.utcnow() + timedelta(seconds=current_app.config[lifetime])
+
+
+def instrumented(cls):
+    """Time every validate_ and get_ method of an OAuthProvider class."""
+    for name, attr in vars(cls).items():
+        if name.startswith(("validate_", "get_")) and callable(attr):
+            setattr(cls, name, _timed(name, attr))
+    return cls
+
+
+@instrumented
 class MongoProvider(OAuthProvider):
 
     @property
@@ -37,6 +84,51 @@ class MongoProvider(OAuthProvider):
     def nonce_length(self):
         return 20, 40
 
+    @property
+    def access_token_length(self):
+        # signed tokens are longer than generated ones
+        return 20, max(30, signed_tokens.length)
+
+    def access_token(self):
+        client_key = request.oauth.client_key
+        request_token = request.oauth.resource_owner_key
+
+        if signed_tokens.enabled:
+            # the verifier was checked, so both exist
+            client = find_client_by_key(client_key)
+            req_token = RequestToken.find_one({'token': request_token})
+            token_id = ObjectId()
+            access_token = signed_tokens.issue(
+                token_id, client['_id'], req_token['resource_owner_id'],
+                req_token['realm'])
+            token_secret = signed_tokens.secret(access_token)
+        else:
+            token_id = None
+            access_token = generate_token(length=30)
+            token_secret = generate_token(self.secret_length)
+
+        self.save_access_token(client_key, access_token, request_token,
+                               secret=token_secret, token_id=token_id)
+        return urlencode([(u'oauth_token', access_token),
+                          (u'oauth_token_secret', token_secret)])
+
+    def _signed_token(self, client, access_token):
+        """Claims of a signed access token issued to client, else None."""
+        token = getattr(g, "oauth_token", None)
+        if token is None or token["token"] != access_token:
+            token = signed_tokens.verify(access_token)
+        if token and client and token["client_id"] == client["_id"]:
+            return token
+        return None
+
+    def _find_access_token(self, client, access_token):
+        # a signed token stands on its own, even if revoked or expired
+        if signed_tokens.is_signed(access_token):
+            return self._signed_token(client, access_token)
+        if client:
+            return find_access_token(access_token, client['_id'])
+        return None
+
     def authorize(self):
         # HACK: authorize directly if uid is provided and not password protected
         uid = request.values.get('uid')
@@ -46,6 +138,10 @@ class MongoProvider(OAuthProvider):
             token = request.values.get("oauth_token")
             return self.authorized(token)
 
+        # the login and authorize pages live in the website, see async_server.py
+        if "frontend" not in current_app.blueprints:
+            abort(404)
+
         # Check logged in
         if not current_user.is_authenticated():
             next_url = url_for("frontend.login") + "?next=" + request.url
@@ -67,30 +163,19 @@ class MongoProvider(OAuthProvider):
                                    token=token,
                                    client_name=client_name)
 
+    @property
+    def timestamp_lifetime(self):
+        return nonce_store.window
+
     def validate_timestamp_and_nonce(self, client_key, timestamp, nonce,
             request_token=None, access_token=None):
 
-        token = True
-        req_token = True
-        client = Client.find_one({'client_key':client_key})
-
-        if client:
-            nonce = Nonce.find_one({'nonce':nonce, 'timestamp':timestamp,
-                'client_id':client['_id']})
-
-            if nonce:
-                if request_token:
-                    req_token = RequestToken.find_one(
-                        {'_id':nonce['request_token_id'], 'token':request_token})
-
-                if access_token:
-                    token = RequestToken.find_one(
-                        {'_id':nonce['request_token_id'], 'token':access_token})
-
-        return token and req_token and nonce != None
+        return nonce_store.check_and_add(client_key, timestamp, nonce,
+                                         request_token=request_token,
+                                         access_token=access_token)
 
     def validate_redirect_uri(self, client_key, redirect_uri=None):
-        client = Client.find_one({'client_key':client_key})
+        client = find_client_by_key(client_key)
 
         return client != None and (
             len(client['callbacks']) == 1 and redirect_uri is None
@@ -99,7 +184,7 @@ class MongoProvider(OAuthProvider):
 
     def validate_client_key(self, client_key):
         return (
-            Client.find_one({'client_key':client_key}) != None)
+            find_client_by_key(client_key) != None)
 
 
     def validate_requested_realm(self, client_key, realm):
@@ -113,14 +198,11 @@ class MongoProvider(OAuthProvider):
 
         # insert other check, ie on uri here
 
-        client = Client.find_one({'client_key':client_key})
-
-        if client:
-            token = AccessToken.find_one(
-                {'token':access_token, 'client_id': client['_id']})
+        client = find_client_by_key(client_key)
+        token = self._find_access_token(client, access_token)
 
-            if token:
-                return token['realm'] in required_realm
+        if token:
+            return token['realm'] in required_realm
 
         return False
 
@@ -132,16 +214,24 @@ class MongoProvider(OAuthProvider):
     def dummy_resource_owner(self):
         return u'dummy_resource_owner'
 
+    @property
+    def dummy_request_token(self):
+        return u'dummy_request_token'
+
+    @property
+    def dummy_access_token(self):
+        return u'dummy_access_token'
+
     def validate_request_token(self, client_key, resource_owner_key):
         # TODO: make client_key optional
         token = None
 
         if client_key:
-            client = Client.find_one({'client_key':client_key})
+            client = find_client_by_key(client_key)
 
             if client:
                 token = RequestToken.find_one(
-                    {'token':access_token, 'client_id': client['_id']})
+                    {'token':resource_owner_key, 'client_id': client['_id']})
 
         else:
             token = RequestToken.find_one(
@@ -152,19 +242,20 @@ class MongoProvider(OAuthProvider):
 
     def validate_access_token(self, client_key, resource_owner_key):
 
-        token = None
-        client = Client.find_one({'client_key':client_key})
+        client = find_client_by_key(client_key)
+        token = self._find_access_token(client, resource_owner_key)
 
-        if client:
-            token = AccessToken.find_one(
-                {'token':resource_owner_key, 'client_id': client['_id']})
+        if token:
+            # the helpers resolve the request's client and user from these
+            g.oauth_client = client
+            g.oauth_token = token
 
         return token != None
 
 
     def validate_verifier(self, client_key, resource_owner_key, verifier):
         token = None
-        client = Client.find_one({'client_key':client_key})
+        client = find_client_by_key(client_key)
 
         if client:
             token = RequestToken.find_one(
@@ -186,7 +277,7 @@ class MongoProvider(OAuthProvider):
 
 
     def get_realm(self, client_key, request_token):
-        client = Client.find_one({'client_key':client_key})
+        client = find_client_by_key(client_key)
 
         if client:
             token = RequestToken.find_one(
@@ -199,7 +290,7 @@ class MongoProvider(OAuthProvider):
 
 
     def get_client_secret(self, client_key):
-            client = Client.find_one({'client_key':client_key})
+            client = find_client_by_key(client_key)
 
             if client:
                 return client.get('secret')
@@ -208,7 +299,7 @@ class MongoProvider(OAuthProvider):
 
 
     def get_rsa_key(self, client_key):
-            client = Client.find_one({'client_key':client_key})
+            client = find_client_by_key(client_key)
 
             if client:
                 return client.get('pubkey')
@@ -216,7 +307,7 @@ class MongoProvider(OAuthProvider):
                 return None
 
     def get_request_token_secret(self, client_key, resource_owner_key):
-        client = Client.find_one({'client_key':client_key})
+        client = find_client_by_key(client_key)
 
         if client:
             token = RequestToken.find_one(
@@ -230,36 +321,39 @@ class MongoProvider(OAuthProvider):
 
 
     def get_access_token_secret(self, client_key, resource_owner_key):
-        client = Client.find_one({'client_key':client_key})
-
-        if client:
-            token = AccessToken.find_one(
-                {'token':resource_owner_key,
-                 'client_id': client['_id']})
+        client = find_client_by_key(client_key)
+        token = self._find_access_token(client, resource_owner_key)
 
-            if token:
-                return token.get('secret')
+        if token:
+            if signed_tokens.is_signed(resource_owner_key):
+                return signed_tokens.secret(resource_owner_key)
+            return token.get('secret')
 
         return None
 
     def save_request_token(self, client_key, request_token, callback,
             realm=None, secret=None):
-        client = Client.find_one({'client_key':client_key})
+        client = find_client_by_key(client_key)
 
         if client:
             token = RequestToken(
-                request_token, callback, secret=secret, realm=realm)
+                request_token, callback, secret=secret, realm=realm,
+                expires_at=_expiry("REQUEST_TOKEN_LIFETIME"))
             token.client_id = client['_id']
 
             RequestToken.insert(token)
 
     def save_access_token(self, client_key, access_token, request_token,
-            realm=None, secret=None):
-        client = Client.find_one({'client_key':client_key})
+            realm=None, secret=None, token_id=None):
+        client = find_client_by_key(client_key)
 
         if client:
-            token = AccessToken(access_token, secret=secret, realm=realm)
+            token = AccessToken(access_token, secret=secret, realm=realm,
+                                expires_at=_expiry("ACCESS_TOKEN_LIFETIME"))
             token.client_id = client['_id']
+            if token_id:
+                # a signed token names its document
+                token['_id'] = token_id
 
             req_token = RequestToken.find_one({'token':request_token})
 
@@ -268,35 +362,22 @@ class MongoProvider(OAuthProvider):
                 token['realm'] = req_token['realm']
 
                 AccessToken.insert(token)
+                invalidate_access_token(access_token, client['_id'])
 
                 # make sure device exist
                 device = get_or_create_device(token)
 
     def save_timestamp_and_nonce(self, client_key, timestamp, nonce,
             request_token=None, access_token=None):
-
-        client = Client.find_one({'client_key':client_key})
-
-        if client:
-            nonce = Nonce(nonce, timestamp)
-            nonce.client_id = client['_id']
-
-            if request_token:
-                req_token = RequestToken.find_one({'token':request_token})
-                nonce.request_token_id = req_token['_id']
-
-            if access_token:
-                token = AccessToken.find_one({'token':access_token})
-                nonce.access_token_id = token['_id']
-
-            Nonce.insert(nonce)
+        # already recorded by validate_timestamp_and_nonce
+        pass
 
     def save_verifier(self, request_token, verifier):
-        token = RequestToken.find_one({'token': request_token})
+        token = RequestToken.load(RequestToken.find_one({'token': request_token}))
         token['verifier'] = verifier
         if hasattr(g, 'hack_user'):
             user, g.hack_user = g.hack_user, None
         else:
             user = current_user
         token['resource_owner_id'] = user['_id']
-        RequestToken.get_collection().save(token)
+        RequestToken.save(token)
@@ -0,0 +1,96 @@
+import logging
+from datetime import datetime, timedelta
+from flask import current_app
+from ..common.metrics import metrics
+from .models import ResourceOwner as User, Client, Device
+from .models import RequestToken, AccessToken, Nonce
+
+
+logger = logging.getLogger(__name__)
+
+reclaimed = metrics.counter(
+    "mgserver_sweeper_reclaimed_total",
+    "Expired tokens and dangling ids removed by the sweeper.",
+    ["collection", "field"])
+
+# arrays of ids left on owners and clients until manage.py migrate_owners
+# drops them, and where the ids point
+REFERENCES = [
+    (User, "request_tokens", RequestToken),
+    (User, "access_tokens", AccessToken),
+    (User, "client_ids", Client),
+    (User, "device_ids", Device),
+    (Client, "request_tokens", RequestToken),
+    (Client, "access_tokens", AccessToken),
+    ]
+
+
+def expire_legacy(model, lifetime):
+    """Give documents of model saved before they expired an expires_at,
+    lifetime seconds from now, so their TTL index picks them up."""
+    expires_at = datetime.utcnow() + timedelta(seconds=lifetime)
+    result = model.modify({"expires_at": None},
+                          {"$set": {"expires_at": expires_at}},
+                          multi=True)
+    return result["n"] if result else 0
+
+
+def remove_expired(model):
+    """Remove the expired documents of model, return how many.
+
+    The TTL index does the same about once a minute, this keeps count.
+    """
+    result = model.remove({"expires_at": {"$lt": datetime.utcnow()}})
+    removed = result["n"] if result else 0
+    reclaimed.inc(removed, model.table, "")
+    return removed
+
+
+def _prune_batch(model, field, target, batch):
+    ids = set(i for doc in batch for i in doc[field])
+    existing = set(doc["_id"] for doc in
+                   target.find({"_id": {"$in": list(ids)}}, ["_id"]))
+    pruned = 0
+    for doc in batch:
+        dangling = [i for i in doc[field] if i not in existing]
+        if dangling:
+            model.modify({"_id": doc["_id"]},
+                         {"$pull": {field: {"$in": dangling}},
+                          "$set": {"updated_since": datetime.utcnow()}})
+            pruned += len(dangling)
+    return pruned
+
+
+def prune_dangling(model, field, target, batch_size):
+    """Pull ids of documents target no longer has from model's field.
+
+    Documents are checked batch_size at a time, one lookup in target each.
+    Only documents with ids in field are read, none once migrated.
+    """
+    pruned, batch = 0, []
+    spec = {field: {"$exists": True, "$ne": []}}
+    for doc in model.find(spec, [field]).batch_size(batch_size):
+        batch.append(doc)
+        if len(batch) == batch_size:
+            pruned += _prune_batch(model, field, target, batch)
+            batch = []
+    if batch:
+        pruned += _prune_batch(model, field, target, batch)
+    reclaimed.inc(pruned, model.table, field)
+    return pruned
+
+
+def sweep(batch_size=None):
+    """One pass over expired tokens and dangling ids, returns the counts."""
+    batch_size = batch_size or current_app.config["SWEEPER_BATCH_SIZE"]
+    counts = {}
+    expire_legacy(RequestToken, current_app.config["REQUEST_TOKEN_LIFETIME"])
+    # a nonce only guards its timestamp window
+    expire_legacy(Nonce, current_app.config["NONCE_TIMESTAMP_WINDOW"])
+    for model in (RequestToken, AccessToken):
+        counts[model.table] = remove_expired(model)
+    for model, field, target in REFERENCES:
+        counts["%s.%s" % (model.table, field)] = \
+            prune_dangling(model, field, target, batch_size)
+    logger.info("sweep reclaimed %s", counts)
+    return counts
@@ -0,0 +1,126 @@
+import hashlib
+import hmac
+import struct
+import threading
+import time
+from binascii import hexlify, unhexlify
+from datetime import datetime
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+from .models import RevokedToken
+
+
+# version, token id, client id, resource owner id, expiry, realm
+_PAYLOAD = struct.Struct(">B12s12s12sI8s")
+_VERSION = 1
+_MAC_SIZE = 16
+
+
+class SignedTokens(object):
+    """Access tokens that carry their own claims.
+
+    With SIGNED_ACCESS_TOKENS on, an access token is the hex encoding of
+    its id, client id, resource owner id, expiry and realm, followed by an
+    HMAC of those keyed from ACCESS_TOKEN_KEY (SECRET_KEY if unset). The
+    token secret is derived from the token the same way, so validating a
+    signed request reads nothing from the database.
+
+    Revoked token ids are kept in memory and refreshed from the
+    revokedTokens collection every TOKEN_REVOCATION_SYNC seconds.
+    """
+
+    length = (_PAYLOAD.size + _MAC_SIZE) * 2
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self._key = None
+        self._revoked = frozenset()
+        self._synced_at = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config["SIGNED_ACCESS_TOKENS"]
+        secret = app.config["ACCESS_TOKEN_KEY"] or app.config["SECRET_KEY"]
+        self._key = hmac.new(secret, "mgserver access token", hashlib.sha256).digest()
+        self.lifetime = app.config["ACCESS_TOKEN_LIFETIME"]
+        self.sync_interval = app.config["TOKEN_REVOCATION_SYNC"]
+        self._revoked = frozenset()
+        self._synced_at = 0
+
+    def _mac(self, payload):
+        return hmac.new(self._key, payload, hashlib.sha256).digest()[:_MAC_SIZE]
+
+    def issue(self, token_id, client_id, resource_owner_id, realm):
+        """A new token, valid for ACCESS_TOKEN_LIFETIME seconds."""
+        payload = _PAYLOAD.pack(_VERSION,
+                                token_id.binary,
+                                client_id.binary,
+                                resource_owner_id.binary,
+                                int(time.time()) + self.lifetime,
+                                (realm or "").encode("utf-8"))
+        return unicode(hexlify(payload + self._mac(payload)))
+
+    def secret(self, token):
+        """The token secret, derived instead of stored."""
+        return unicode(hmac.new(self._key, "secret:" + token.encode("utf-8"),
+                                hashlib.sha256).hexdigest()[:30])
+
+    def is_signed(self, token):
+        return self.enabled and token is not None and len(token) == self.length
+
+    def verify(self, token):
+        """The claims of a valid, unexpired and unrevoked token, else None.
+
+        Claims look like the AccessToken document the token stands for.
+        """
+        if not self.is_signed(token):
+            return None
+        try:
+            raw = unhexlify(token)
+        except TypeError:
+            return None
+        payload, mac = raw[:-_MAC_SIZE], raw[-_MAC_SIZE:]
+        if not hmac.compare_digest(self._mac(payload), mac):
+            return None
+
+        version, token_id, client_id, owner_id, expires, realm = \
+            _PAYLOAD.unpack(payload)
+        if version != _VERSION or expires < time.time():
+            return None
+        token_id = ObjectId(token_id)
+        if token_id in self.revoked():
+            return None
+        return {
+            "_id": token_id,
+            "token": token,
+            "client_id": ObjectId(client_id),
+            "resource_owner_id": ObjectId(owner_id),
+            "realm": realm.rstrip("\0").decode("utf-8"),
+            "expires_at": datetime.utcfromtimestamp(expires),
+            }
+
+    def revoked(self):
+        """Ids of revoked tokens, refreshed every sync interval."""
+        if time.time() - self._synced_at > self.sync_interval:
+            with self._lock:
+                if time.time() - self._synced_at > self.sync_interval:
+                    self.sync()
+        return self._revoked
+
+    def sync(self):
+        self._revoked = frozenset(
+            doc["_id"] for doc in RevokedToken.find({}, ["_id"]))
+        self._synced_at = time.time()
+
+    def revoke(self, claims):
+        """Reject the token from now on, on every node after its next sync."""
+        try:
+            RevokedToken.insert(RevokedToken(claims["_id"], claims["expires_at"]))
+        except DuplicateKeyError:
+            pass
+        self._revoked = self._revoked | frozenset([claims["_id"]])
+
+
+signed_tokens = SignedTokens()
@@ -1,12 +1,91 @@
 from .database import MongoProvider
 provider = MongoProvider(None)
 
+from .database import MongoConnection
+mongo = MongoConnection()
+
+from .database import secrets_cache
+
+from .database import nonce_store
+
+from .database import signed_tokens
+
+from .database import query_profiler
+
+from .common.metrics import metrics
+
 from flask.ext.login import LoginManager
 login_manager = LoginManager()
 
 from flask.ext.bcrypt import Bcrypt
 bcrypt = Bcrypt()
 
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+from .common import HasherBusyException
+class MGPasswordHasher:
+    """Run bcrypt on a bounded pool of worker threads.
+
+    At most PASSWORD_HASH_QUEUE_DEPTH hashes may be queued or running,
+    further requests fail fast with HasherBusyException instead of piling
+    up on the request threads.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+        self._dummy_hash = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.rounds = app.config["BCRYPT_LOG_ROUNDS"]
+        self.workers = app.config["PASSWORD_HASH_WORKERS"]
+        self.slots = threading.BoundedSemaphore(
+            app.config["PASSWORD_HASH_QUEUE_DEPTH"])
+        self._dummy_password = app.config["DUMMY_PASSWORD"]
+        self._dummy_hash = None
+
+    def _get_pool(self):
+        # worker threads do not survive a fork
+        if self._pool is None or self._pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pid != os.getpid():
+                    self._pool = ThreadPool(self.workers)
+                    self._pid = os.getpid()
+        return self._pool
+
+    def _run(self, func, *args):
+        if not self.slots.acquire(False):
+            raise HasherBusyException()
+        try:
+            return self._get_pool().apply_async(func, args).get()
+        finally:
+            self.slots.release()
+
+    def generate(self, password):
+        return self._run(bcrypt.generate_password_hash, password, self.rounds)
+
+    def check(self, pw_hash, password):
+        return self._run(bcrypt.check_password_hash, pw_hash, password)
+
+    @property
+    def dummy_hash(self):
+        """Hash compared against when there is no user, to keep timing even."""
+        if self._dummy_hash is None:
+            self._dummy_hash = self.generate(self._dummy_password)
+        return self._dummy_hash
+
+    def needs_rehash(self, pw_hash):
+        try:
+            return int(pw_hash.split("$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return False
+
+hasher = MGPasswordHasher()
+
 import pyotp
 class MGTotp:
     def __init__(self, app=None):
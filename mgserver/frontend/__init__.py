@@ -1 +1,2 @@
 from .views import frontend
+from .fragments import fragment_cache
@@ -0,0 +1,41 @@
+from flask import current_app, render_template
+from jinja2 import Markup
+from ..common import Cache
+from ..common.metrics import metrics
+
+
+fragment_lookups = metrics.counter(
+    "mgserver_fragment_cache_lookups_total",
+    "Rendered page fragments served from the cache or rendered.",
+    ["fragment", "result"])
+
+# Rendered fragments, keyed by user and the version of the data they show.
+# A write gives the data a new version, so entries never need deleting,
+# they just stop being asked for and age out.
+fragment_cache = Cache()
+
+
+def newest(model, user_id, field):
+    """(field, _id) of the user's most recently changed document."""
+    stamp = list(model
+                 .find({"resource_owner_id": user_id}, [field])
+                 .sort([(field, -1), ("_id", -1)])
+                 .limit(1))
+    return (stamp[0].get(field), stamp[0]["_id"]) if stamp else None
+
+
+def render_fragment(template, user_id, version, **context):
+    """template rendered with context, cached for this user and version.
+
+    context is only read on a miss, so it may hold lazy cursors.
+    """
+    key = ("fragment", template, user_id, version)
+    html = fragment_cache.get(key)
+    if html is None:
+        fragment_lookups.inc(1, template, "miss")
+        html = render_template(template, **context)
+        fragment_cache.set(key, html,
+                           current_app.config["FRAGMENT_CACHE_TIMEOUT"])
+    else:
+        fragment_lookups.inc(1, template, "hit")
+    return Markup(html)
@@ -1,19 +1,25 @@
-from flask import current_app
-from ..extensions import bcrypt
-from ..database import ResourceOwner as User
+from ..extensions import hasher
+from ..database import ResourceOwner as User, invalidate_user
 
 
 def get_valid_user(email, pw = ""):
     """Return instance of ResourceOwner if credentials are valid
+
+    Stored hashes made with another cost factor are upgraded on success.
     """
-    pw_hash = bcrypt.generate_password_hash(current_app.config['DUMMY_PASSWORD'])
+    pw_hash = hasher.dummy_hash
     user_dict = User.find_one({'email': email})
-    if user_dict and 'pw_hash' in user_dict:
+    if user_dict and user_dict.get('pw_hash'):
         pw_hash = user_dict['pw_hash']
 
-    if bcrypt.check_password_hash(pw_hash, pw) and user_dict:
-        user = User()
-        user.update(user_dict)
-        return user
-    else:
+    # checked even without a stored hash, so every miss takes as long
+    valid = hasher.check(pw_hash, pw)
+    if not (user_dict and user_dict.get('pw_hash') and valid):
         return None
+
+    if hasher.needs_rehash(pw_hash):
+        user_dict['pw_hash'] = hasher.generate(pw)
+        User.modify({'_id': user_dict['_id']},
+                    {'$set': {'pw_hash': user_dict['pw_hash']}})
+        invalidate_user(user_dict['_id'])
+    return User.load(user_dict)
@@ -1,10 +1,11 @@
 from flask import Blueprint, render_template, redirect, flash, url_for
 from flask.ext.login import current_user, login_required, login_user, logout_user
-from bson.objectid import ObjectId
 from ..common import CreateClientException, SignupException
+from ..common import HasherBusyException
 from ..database import Client, Device
 from ..database import create_user, create_client
 from .forms import LoginForm, SignupForm, ClientForm
+from .fragments import render_fragment, newest
 from .utils import get_valid_user
 
 
@@ -28,10 +29,11 @@ def account():
 @frontend.route('/devices')
 @login_required
 def devices():
-    devices = Device.find({
-        "_id": {"$in": [ObjectId(oid) for oid in current_user.client_ids]},
-    })
-    return render_template('devices.html', devices=devices)
+    user_id = current_user["_id"]
+    rows = render_fragment(
+        '_devices.html', user_id, newest(Device, user_id, "updated_since"),
+        devices=Device.find({"resource_owner_id": user_id}).sort("updated_since", -1))
+    return render_template('devices.html', rows=rows)
 
 
 @frontend.route('/apps', methods=['GET', 'POST'])
@@ -48,8 +50,12 @@ def apps():
             flash("{}".format(e))
         return redirect(url_for('frontend.apps'))
 
-    clients = Client.find({"resource_owner_id": current_user["_id"]}).sort("created_at", -1)
-    return render_template('apps.html', clients=clients, form=form)
+    # the form carries a CSRF token, only the list is cached
+    user_id = current_user["_id"]
+    rows = render_fragment(
+        '_clients.html', user_id, newest(Client, user_id, "created_at"),
+        clients=Client.find({"resource_owner_id": user_id}).sort("created_at", -1))
+    return render_template('apps.html', rows=rows, form=form)
 
 
 @frontend.route('/login', methods=['GET', 'POST'])
@@ -61,13 +67,17 @@ def login():
     form = LoginForm()
     error = None
     if form.validate_on_submit():
-        user = get_valid_user(form.email.data, form.password.data)
-        if user:
-            login_user(user, remember=form.remember.data)
-            flash('Signed in successfully.')
-            return form.redirect('frontend.index')
+        try:
+            user = get_valid_user(form.email.data, form.password.data)
+        except HasherBusyException as e:
+            error = e.msg
         else:
-            error = "Invalid credentials"
+            if user:
+                login_user(user, remember=form.remember.data)
+                flash('Signed in successfully.')
+                return form.redirect('frontend.index')
+            else:
+                error = "Invalid credentials"
 
     return render_template('login.html', form=form, error=error)
 
@@ -96,5 +106,7 @@ def signup():
             return form.redirect('frontend.index')
         except SignupException as e:
             error = e.value
+        except HasherBusyException as e:
+            error = e.msg
 
     return render_template('signup.html', error=error, form=form)
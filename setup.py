@@ -34,5 +34,9 @@ setup(
         'nose',
         'blinker',
         'coverage'
-    ]
+    ],
+    extras_require={
+        # async_server.py
+        'async': ['gevent'],
+    }
 )
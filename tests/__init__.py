@@ -1,24 +1,22 @@
-import pymongo
 from flask import url_for
 from flask.ext.testing import TestCase as Base
 from flask.ext.restful import marshal
 from mgserver import create_app
 from mgserver.configs import TestConfig
+from mgserver.extensions import mongo
 from mgserver.api import user_fields, device_fields
 from mgserver.database import ResourceOwner as User, AccessToken, Device
 from mgserver.database import create_user, create_client
-from mgserver.database import get_or_create_device
+from mgserver.database import get_or_create_device, with_owned_ids
+from mgserver.database import ensure_indexes
 
 
 def create_access_token(token, user, client):
-    token = AccessToken(token="known_token")
+    token = AccessToken(token=token)
     token["resource_owner_id"] = user["_id"]
     token["client_id"] = client["_id"]
     AccessToken.save(token)
 
-    user["access_tokens"].append(token["_id"])
-    User.save(user)
-
     return token
 
 
@@ -61,20 +59,17 @@ class TestCase(Base):
         user = User()
         user.update(user_dict)
         self.known_user = user
-        self.known_user_marshalled = marshal(user, user_fields)
+        self.known_user_marshalled = marshal(with_owned_ids(user), user_fields)
 
     def setUp(self):
         """Reset all tables before testing."""
-        connection = pymongo.MongoClient(self.app.config["MONGO_HOST"],
-                                         self.app.config["MONGO_PORT"])
-        connection.drop_database(self.app.config["MONGO_DATABASE"])
+        mongo.client.drop_database(self.app.config["MONGO_DATABASE"])
+        ensure_indexes()
         self.init_data()
 
     def tearDown(self):
         """Drop unittesting database."""
-        connection = pymongo.MongoClient(self.app.config["MONGO_HOST"],
-                                         self.app.config["MONGO_PORT"])
-        connection.drop_database(self.app.config["MONGO_DATABASE"])
+        mongo.client.drop_database(self.app.config["MONGO_DATABASE"])
 
     def login(self, email, password, follow_redirects=True):
         data = {
@@ -1,10 +1,28 @@
+import uuid
 from datetime import datetime
+from urlparse import urlsplit, parse_qsl
+from oauthlib.oauth1.rfc5849 import Client as OAuthClient
 from bson.objectid import ObjectId
-from flask.ext.restful import fields
+from flask import json, g
+from flask.ext.restful import fields, marshal
 from mgserver.common import ApiException
-from mgserver.extensions import provider, totp
-from mgserver.api import Epoch
-from tests import TestCase, TestCaseWithoutAuth
+from mgserver import create_app
+from mgserver.configs import TestConfig
+from mgserver.common.metrics import Histogram
+from mgserver.database.provider import oauth_seconds
+from mgserver.extensions import provider, totp, metrics, secrets_cache
+from mgserver.api import api, Epoch, user_fields, device_fields
+from mgserver.api import compile_marshaller, marshal_user, marshal_device
+from mgserver.api.utils import stream_page
+from mgserver.database import ResourceOwner as User, Device, get_or_create_device
+from mgserver.database import query_profiler, signed_tokens, with_owned_ids
+from tests import TestCase, TestCaseWithoutAuth, create_access_token
+
+
+def relative_url(url):
+    """Strip scheme and host, the test client wants a path."""
+    parts = urlsplit(url)
+    return parts.path + "?" + parts.query
 
 
 class TestViews(TestCase):
@@ -29,6 +47,9 @@ class TestViews(TestCase):
         assert "success" == seed["flag"]
         assert str(self.known_user["_id"]) != seed["user_id"]
 
+        user = User.find_one({"_id": ObjectId(seed["user_id"])})
+        assert with_owned_ids(user)["client_ids"] == [self.known_client["_id"]]
+
     def test_seed_invalid_otp(self):
         data = {
             "otp": "1111111111",
@@ -56,6 +77,8 @@ class TestViews(TestCase):
 
         assert "success" == resp.json["flag"]
         assert str(self.known_user["_id"]) == resp.json["res"]["_id"]
+        assert [str(self.known_client["_id"])] == resp.json["res"]["client_ids"]
+        assert [str(self.known_device["_id"])] == resp.json["res"]["device_ids"]
 
     def test_myself_put(self):
         old_timestamp = self.known_user_marshalled["updated_since"]
@@ -91,6 +114,83 @@ class TestViews(TestCase):
         assert str(self.known_device["_id"]) == str(device["_id"])
         assert str(self.known_access_token["_id"]) == str(device["access_token_id"])
 
+    def _create_devices(self, count):
+        for i in range(count):
+            user = User.find_one({"_id": self.known_user["_id"]})
+            token = create_access_token("token_{}".format(i),
+                                        user,
+                                        self.known_client)
+            get_or_create_device(token)
+        user = User()
+        user.update(User.find_one({"_id": self.known_user["_id"]}))
+        self.app.config["TESTING_WITHOUT_OAUTH"]["known_user"] = user
+
+    def test_devices_get_paginated(self):
+        self._create_devices(2)
+
+        seen = []
+        url = "/v1/devices?limit=2"
+        while url:
+            resp = self.client.get(url)
+            assert "success" == resp.json["flag"]
+            assert len(resp.json["res"]) <= 2
+            seen.extend(device["_id"] for device in resp.json["res"])
+            url = resp.json["next"]
+            if url:
+                url = relative_url(url)
+
+        assert len(seen) == 3
+        assert len(set(seen)) == 3
+
+    def test_devices_get_fields(self):
+        resp = self.client.get("/v1/devices?fields=name,vendor")
+        assert "success" == resp.json["flag"]
+
+        device = resp.json["res"][0]
+        assert sorted(device.keys()) == ["_id", "name", "vendor"]
+
+    def test_devices_get_invalid_arguments(self):
+        resp = self.client.get("/v1/devices?fields=secret")
+        self.assert_400(resp)
+
+        resp = self.client.get("/v1/devices?cursor=garbage")
+        self.assert_400(resp)
+
+    def test_myself_get_not_modified(self):
+        resp = self.client.get("/v1/me")
+        etag = resp.headers["ETag"]
+        assert resp.headers["Last-Modified"]
+
+        resp = self.client.get("/v1/me", headers={"If-None-Match": etag})
+        self.assertEquals(304, resp.status_code)
+
+        resp = self.client.put("/v1/me", data={"name": "Changed"})
+        resp = self.client.get("/v1/me", headers={"If-None-Match": etag})
+        self.assert_200(resp)
+
+    def test_devices_get_not_modified(self):
+        resp = self.client.get("/v1/devices")
+        etag = resp.headers["ETag"]
+
+        resp = self.client.get("/v1/devices", headers={"If-None-Match": etag})
+        self.assertEquals(304, resp.status_code)
+
+        resp = self.client.get("/v1/devices?fields=name",
+                               headers={"If-None-Match": etag})
+        self.assert_200(resp)
+
+    def test_device_get_if_modified_since(self):
+        url = "/v1/devices/{}".format(str(self.known_device["_id"]))
+        resp = self.client.get(url)
+        last_modified = resp.headers["Last-Modified"]
+
+        resp = self.client.get(url, headers={"If-Modified-Since": last_modified})
+        self.assertEquals(304, resp.status_code)
+
+        self.client.put(url, data={"name": "Changed"})
+        resp = self.client.get("/v1/device", headers={"If-None-Match": "stale"})
+        self.assert_200(resp)
+
     def test_device_get_from_token(self):
         resp = self.client.get("/v1/device")
         assert "success" == resp.json["flag"]
@@ -165,6 +265,159 @@ class TestViews(TestCase):
         device = resp.json["res"]
         assert old_timestamp == device["updated_since"]
 
+    def test_devices_put_batch(self):
+        self._create_devices(2)
+        ids = [str(d["_id"]) for d in Device.find({"resource_owner_id": self.known_user["_id"]})]
+        data = {"devices": [
+                {"_id": ids[0], "name": "First"},
+                {"_id": ids[1], "name": "First"},
+                {"_id": ids[2], "vendor": "Avamagic", "model": "MG"},
+                {"_id": str(ObjectId()), "name": "Someone else's"},
+                {"_id": ids[0], "secret": "nope"},
+                ]}
+        resp = self.client.put("/v1/devices", data=json.dumps(data),
+                               content_type="application/json")
+
+        assert "success" == resp.json["flag"]
+        statuses = [item["status"] for item in resp.json["res"]]
+        assert statuses == ["updated", "updated", "updated", "not_found", "invalid"]
+
+        resp = self.client.get("/v1/devices")
+        devices = dict((d["_id"], d) for d in resp.json["res"])
+        assert devices[ids[0]]["name"] == "First"
+        assert devices[ids[1]]["name"] == "First"
+        assert devices[ids[2]]["vendor"] == "Avamagic"
+        assert devices[ids[2]]["model"] == "MG"
+
+    def test_devices_get_by_ids(self):
+        self._create_devices(1)
+        ids = [str(d["_id"]) for d in Device.find({"resource_owner_id": self.known_user["_id"]})]
+        unknown = str(ObjectId())
+
+        resp = self.client.get("/v1/devices?ids={},{},{}&fields=name".format(
+                ids[0], ids[1], unknown))
+        assert "success" == resp.json["flag"]
+        res = resp.json["res"]
+        assert sorted(res.keys()) == sorted(ids + [unknown])
+        assert res[unknown] is None
+        assert res[ids[0]] == {"_id": ids[0], "name": ""}
+
+        resp = self.client.post("/v1/devices",
+                                data=json.dumps({"ids": ids + ["garbage"]}),
+                                content_type="application/json")
+        res = resp.json["res"]
+        assert res["garbage"] is None
+        assert res[ids[1]]["_id"] == ids[1]
+
+        resp = self.client.get("/v1/devices?ids={}".format(ids[0].upper()))
+        assert resp.json["res"][ids[0].upper()]["_id"] == ids[0]
+        assert "access_token_id" in res[ids[1]]
+
+    def test_devices_put_batch_invalid(self):
+        resp = self.client.put("/v1/devices", data=json.dumps({"devices": []}),
+                               content_type="application/json")
+        self.assert_400(resp)
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.app.config["TESTING_WITHOUT_OAUTH"] = {
+            "known_user": self.known_user,
+            "known_client": self.known_client,
+            "known_device": self.known_device,
+            }
+
+    def test_request_and_mongo_metrics(self):
+        self.client.get("/v1/devices")
+        resp = self.client.get("/metrics")
+        self.assert_200(resp)
+
+        text = resp.data
+        assert 'mgserver_request_seconds_count{endpoint="api.devices",method="GET",status="200"}' in text
+        assert 'mgserver_request_phase_seconds_count{endpoint="api.devices",phase="mongo"}' in text
+        assert 'mgserver_request_phase_seconds_count{endpoint="api.devices",phase="app"}' in text
+        assert 'mgserver_mongo_operation_seconds_count{collection="devices",operation="find"}' in text
+
+    def test_oauth_metrics(self):
+        with self.app.test_request_context():
+            provider.validate_client_key(self.known_client["client_key"])
+            assert metrics.phases()["oauth"][1] == 1
+        assert oauth_seconds.count("validate_client_key") >= 1
+
+    def test_histogram_exposition(self):
+        histogram = Histogram("latency", "Latency.", ["path"], buckets=(0.1, 1))
+        histogram.observe(0.05, "/a")
+        histogram.observe(0.5, "/a")
+        samples = list(histogram.samples())
+        assert samples == [
+            ("latency_bucket", '{path="/a",le="0.1"}', 1),
+            ("latency_bucket", '{path="/a",le="1.0"}', 2),
+            ("latency_bucket", '{path="/a",le="+Inf"}', 2),
+            ("latency_sum", '{path="/a"}', 0.55),
+            ("latency_count", '{path="/a"}', 2),
+            ]
+
+
+class TestMetricsDisabled(TestCaseWithoutAuth):
+
+    def create_app(self):
+        class Config(TestConfig):
+            METRICS_ENABLED = False
+        return create_app(Config)
+
+    def test_no_endpoint(self):
+        self.assert_404(self.client.get("/metrics"))
+        assert not metrics.enabled
+
+
+class TestQueryProfiler(TestCase):
+
+    def setUp(self):
+        super(TestQueryProfiler, self).setUp()
+        self.app.config["TESTING_WITHOUT_OAUTH"] = {
+            "known_user": self.known_user,
+            "known_client": self.known_client,
+            "known_device": self.known_device,
+            }
+
+    def test_off_by_default(self):
+        resp = self.client.get("/v1/me")
+        assert "X-Query-Count" not in resp.headers
+
+    def test_header(self):
+        resp = self.client.get("/v1/me", headers={"X-Profile-Queries": "1"})
+        # the user's stamp, then clients and devices for the id lists
+        assert int(resp.headers["X-Query-Count"]) == 3
+        assert resp.headers["X-Query-Time"].endswith("ms")
+
+    def test_records_shape_and_site(self):
+        with self.app.test_request_context(headers={"X-Profile-Queries": "1"}):
+            query_profiler.begin()
+            get_or_create_device(self.known_access_token)
+            list(Device.find({"_id": {"$in": [self.known_device["_id"]]}}))
+
+            first, second = g.query_profile
+            assert first["shape"] == {"access_token_id": "?"}
+            assert first["operation"] == "find_one"
+            assert first["site"].startswith("mgserver/database/helper.py:")
+            assert second["shape"] == {"_id": {"$in": ["?"]}}
+            query_profiler.end()
+
+    def test_threshold_warning(self):
+        self.app.config["QUERY_PROFILER"] = True
+        self.app.config["QUERY_PROFILER_THRESHOLD"] = 0
+        query_profiler.init_app(self.app)
+        warnings = []
+        self.app.logger.warning = lambda *args: warnings.append(args)
+        try:
+            self.client.get("/v1/me")
+        finally:
+            del self.app.logger.warning
+        assert len(warnings) == 1
+        assert "made 3 queries" in warnings[0][0] % warnings[0][1:]
+
 
 class TestOAuth(TestCase):
 
@@ -172,6 +425,135 @@ class TestOAuth(TestCase):
         response = self.client.get('/v1/devices')
         self.assert_400(response)
 
+    def signed(self, signer, method, path):
+        _, headers, _ = signer.sign(u"http://localhost" + path, method)
+        return self.client.open(path, method=method, headers=headers)
+
+    def authorize(self):
+        """Go through the OAuth flow for a new seed user."""
+        client = self.known_client
+        seed = self.client.post("/v1/seeds", data={
+                "otp": str(totp.now()),
+                "consumer_key": client["client_key"],
+                }).json
+
+        signer = OAuthClient(client["client_key"], client_secret=client["secret"],
+                             callback_uri=client["callbacks"][0])
+        resp = self.signed(signer, u"POST", u"/v1/request_token?realm=users")
+        self.assert_200(resp)
+        request_token = dict(parse_qsl(resp.data))
+
+        resp = self.client.get("/v1/authorize", query_string={
+                "oauth_token": request_token["oauth_token"],
+                "uid": seed["user_id"],
+                })
+        verifier = dict(parse_qsl(urlsplit(resp.headers["Location"]).query))
+
+        signer = OAuthClient(client["client_key"], client_secret=client["secret"],
+                             resource_owner_key=request_token["oauth_token"],
+                             resource_owner_secret=request_token["oauth_token_secret"],
+                             verifier=unicode(verifier["oauth_verifier"]))
+        resp = self.signed(signer, u"POST", u"/v1/access_token")
+        self.assert_200(resp)
+        access_token = dict(parse_qsl(resp.data))
+
+        signer = OAuthClient(client["client_key"], client_secret=client["secret"],
+                             resource_owner_key=access_token["oauth_token"],
+                             resource_owner_secret=access_token["oauth_token_secret"])
+        return seed["user_id"], signer
+
+    def test_access_token_flow(self):
+        user_id, signer = self.authorize()
+        resp = self.signed(signer, u"GET", u"/v1/me")
+        self.assert_200(resp)
+        assert user_id == resp.json["res"]["_id"]
+
+    def test_token_resolved_once(self):
+        user_id, signer = self.authorize()
+        secrets_cache.clear()
+        with self.app.test_request_context(
+                "/v1/device", headers=dict(signer.sign(u"http://localhost/v1/device")[1])):
+            query_profiler.always = True
+            self.app.preprocess_request()
+            response = self.app.dispatch_request()
+            collections = [q["collection"] for q in g.query_profile]
+        assert response.status_code == 200
+        assert collections.count("accessTokens") == 1
+        assert collections.count("clients") == 1
+
+    def test_device_not_modified(self):
+        user_id, signer = self.authorize()
+        etag = self.signed(signer, u"GET", u"/v1/device").headers["ETag"]
+        headers = dict(signer.sign(u"http://localhost/v1/device")[1])
+        headers["If-None-Match"] = etag
+        with self.app.test_request_context("/v1/device", headers=headers):
+            query_profiler.always = True
+            self.app.preprocess_request()
+            response = self.app.dispatch_request()
+            collections = [q["collection"] for q in g.query_profile]
+        assert response.status_code == 304
+        assert collections.count("devices") == 1
+
+    def test_revoke(self):
+        user_id, signer = self.authorize()
+        self.assert_200(self.signed(signer, u"DELETE", u"/v1/access_token"))
+        resp = self.signed(signer, u"GET", u"/v1/me")
+        assert resp.status_code in (401, 403)
+
+
+class TestSignedTokens(TestOAuth):
+
+    def create_app(self):
+        class Config(TestConfig):
+            SIGNED_ACCESS_TOKENS = True
+        return create_app(Config)
+
+    def test_token_resolved_once(self):
+        user_id, signer = self.authorize()
+        secrets_cache.clear()
+        with self.app.test_request_context(
+                "/v1/device", headers=dict(signer.sign(u"http://localhost/v1/device")[1])):
+            query_profiler.always = True
+            self.app.preprocess_request()
+            response = self.app.dispatch_request()
+            collections = [q["collection"] for q in g.query_profile]
+        assert response.status_code == 200
+        assert "accessTokens" not in collections
+        assert collections.count("clients") == 1
+
+    def test_revoked_on_other_nodes(self):
+        user_id, signer = self.authorize()
+        self.assert_200(self.signed(signer, u"DELETE", u"/v1/access_token"))
+        # a node that has not synced yet
+        signed_tokens._revoked, signed_tokens._synced_at = frozenset(), 0
+        resp = self.signed(signer, u"GET", u"/v1/me")
+        assert resp.status_code in (401, 403)
+
+    def test_verify(self):
+        ids = ObjectId(), ObjectId(), ObjectId()
+        with self.app.test_request_context():
+            token = signed_tokens.issue(ids[0], ids[1], ids[2], u"users")
+            claims = signed_tokens.verify(token)
+            assert len(token) == signed_tokens.length
+            assert (claims["_id"], claims["client_id"], claims["resource_owner_id"]) == ids
+            assert claims["realm"] == u"users"
+
+            flipped = "0" if token[40] != "0" else "1"
+            assert signed_tokens.verify(token[:40] + flipped + token[41:]) is None
+
+            signed_tokens.lifetime = -1
+            assert signed_tokens.verify(signed_tokens.issue(*ids + (u"users",))) is None
+
+
+class TestApiOnly(TestCaseWithoutAuth):
+
+    def create_app(self):
+        return create_app(TestConfig, blueprints=(api,))
+
+    def test_authorize_without_frontend(self):
+        resp = self.client.get("/v1/authorize", query_string={"oauth_token": "x"})
+        self.assert_404(resp)
+
 
 class TestExceptions(TestCaseWithoutAuth):
 
@@ -201,3 +583,45 @@ class TestUtils(TestCaseWithoutAuth):
         field = Epoch()
         with self.assertRaises(fields.MarshallingException):
             field.output("bar", obj)
+
+    def test_stream_page(self):
+        marshaller = lambda item: {"n": item}
+        next_url = lambda last: "after-{}".format(last)
+
+        body = "".join(stream_page([], 2, marshaller, next_url))
+        self.assertEquals({"flag": "success", "res": [], "next": None},
+                          json.loads(body))
+
+        body = "".join(stream_page([1, 2, 3], 2, marshaller, next_url))
+        self.assertEquals({"flag": "success",
+                           "res": [{"n": 1}, {"n": 2}],
+                           "next": "after-2"},
+                          json.loads(body))
+
+    def test_compiled_marshaller(self):
+        device = {
+            "_id": ObjectId(),
+            "name": u"Device",
+            "description": None,
+            "vendor": "Avamagic",
+            "mgserver_id": uuid.uuid4(),
+            "access_token_id": ObjectId(),
+            "created_at": datetime(2013, 2, 27, 15, 21, 53),
+            "updated_since": datetime(2013, 2, 28, 15, 21, 53, 1000),
+            }
+        self.assertEquals(marshal(device, device_fields),
+                          marshal_device(device))
+
+        user = {
+            "_id": ObjectId(),
+            "name": u"User",
+            "client_ids": [ObjectId(), ObjectId()],
+            "device_ids": [],
+            "created_at": datetime(2013, 2, 27, 15, 21, 53),
+            }
+        self.assertEquals(marshal(user, user_fields), marshal_user(user))
+
+    def test_compiled_marshaller_fallback(self):
+        spec = {"count": fields.Integer, "name": fields.String(default="x")}
+        self.assertEquals(marshal({"count": 3}, spec),
+                          compile_marshaller(spec)({"count": 3}))
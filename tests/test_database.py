@@ -0,0 +1,427 @@
+import time
+from datetime import datetime, timedelta
+from bson import BSON
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from bson.objectid import ObjectId
+from flask import Flask, g
+from mgserver import create_app
+from mgserver.configs import TestConfig
+from mgserver.common import ApiException, ConflictException
+from mgserver.common.cache import SimpleCache
+from mgserver.extensions import mongo, secrets_cache, metrics
+from mgserver.database import ResourceOwner as User, Client, clear_identity_map
+from mgserver.database import index_report, MongoConnection
+from mgserver.database import ensure_indexes, IndexConflict
+from mgserver.database.models import write_stats, mongo_written_bytes
+from mgserver.database import AccessToken, Device, get_or_create_device
+from mgserver.database import RequestToken, Nonce, sweep, migrate_ownership
+from mgserver.database.lookup import find_client_by_key, invalidate_client
+from mgserver.database.lookup import find_access_token, find_user, invalidate_user
+from mgserver.database.sweeper import reclaimed
+from mgserver.database.memory import MemoryClient
+from mgserver.database.nonce import MemoryNonceStore
+from mgserver.extensions import nonce_store
+from tests import TestCase, create_access_token
+
+
+class TestConnection(TestCase):
+
+    def test_client_is_shared(self):
+        User.find_one({"email": "known_user@example.com"})
+        client = mongo.client
+        User.find_one({"email": "known_user@example.com"})
+        assert client is mongo.client
+
+    def test_reset(self):
+        client = mongo.client
+        mongo.reset()
+        assert client is not mongo.client
+
+    def test_stats(self):
+        mongo.client
+        stats = mongo.stats()
+        assert stats["connected"]
+        assert stats["clients_created"] >= 1
+        assert stats["max_pool_size"] == self.app.config["MONGO_MAX_POOL_SIZE"]
+
+    def test_client_settings(self):
+        class Config(TestConfig):
+            STORAGE_ENGINE = "mongo"
+            MONGO_USE_GREENLETS = True
+        # a bare app, so neither self.app nor the mongo extension change
+        app = Flask(__name__)
+        app.config.from_object(Config)
+        connection = MongoConnection()
+        connection.client_class = lambda *args, **kwargs: kwargs
+        connection.init_app(app)
+
+        assert connection.client["use_greenlets"] is True
+        assert connection.client["max_pool_size"] == Config.MONGO_MAX_POOL_SIZE
+
+
+class TestIdentityMap(TestCase):
+
+    def setUp(self):
+        super(TestIdentityMap, self).setUp()
+        clear_identity_map()
+
+    def test_find_one_cached(self):
+        query = {"email": "known_user@example.com"}
+        user = User.find_one(query)
+        assert "users" in g.identity_map
+
+        # modifying the returned copy must not leak into the map
+        user["name"] = "Changed"
+        assert User.find_one(query)["name"] == "Known User"
+
+    def test_save_invalidates(self):
+        query = {"email": "known_user@example.com"}
+        user = User.find_one(query)
+        user["name"] = "Changed"
+        User.save(user)
+
+        assert "users" not in g.identity_map
+        assert User.find_one(query)["name"] == "Changed"
+
+    def test_clear(self):
+        User.find_one({"email": "known_user@example.com"})
+        clear_identity_map()
+        assert g.identity_map == {}
+
+
+class TestSecretsCache(TestCase):
+
+    def test_simple_cache_lru(self):
+        cache = SimpleCache(threshold=2, default_timeout=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+        assert cache.get("c") == 3
+
+    def test_simple_cache_ttl(self):
+        cache = SimpleCache(threshold=2, default_timeout=60)
+        cache.set("a", 1, timeout=-1)
+        assert cache.get("a") is None
+
+    def test_find_client_by_key(self):
+        secrets_cache.clear()
+        client_key = self.known_client["client_key"]
+        misses = secrets_cache.stats()["misses"]
+        hits = secrets_cache.stats()["hits"]
+
+        client = find_client_by_key(client_key)
+        assert client["_id"] == self.known_client["_id"]
+        assert secrets_cache.stats()["misses"] == misses + 1
+
+        client = find_client_by_key(client_key)
+        assert client["_id"] == self.known_client["_id"]
+        assert secrets_cache.stats()["hits"] == hits + 1
+
+    def test_invalidate_client(self):
+        client_key = self.known_client["client_key"]
+        find_client_by_key(client_key)
+
+        client = Client.find_one({"_id": self.known_client["_id"]})
+        client["name"] = "Renamed app"
+        Client.save(client)
+        invalidate_client(client_key)
+
+        assert find_client_by_key(client_key)["name"] == "Renamed app"
+
+    def test_find_user(self):
+        user_id = self.known_user["_id"]
+        assert find_user(user_id)["name"] == "Known User"
+
+        User.modify({"_id": user_id}, {"$set": {"name": "Renamed"}})
+        assert find_user(user_id)["name"] == "Known User"
+        invalidate_user(user_id)
+        assert find_user(user_id)["name"] == "Renamed"
+
+
+class TestNonceStore(TestCase):
+
+    def test_replay_rejected(self):
+        timestamp = unicode(int(time.time()))
+        assert nonce_store.check_and_add(u"client", timestamp, u"nonce")
+        assert not nonce_store.check_and_add(u"client", timestamp, u"nonce")
+        assert nonce_store.check_and_add(u"other_client", timestamp, u"nonce")
+
+    def test_stale_timestamp_rejected(self):
+        timestamp = unicode(int(time.time()) - nonce_store.window - 10)
+        assert not nonce_store.check_and_add(u"client", timestamp, u"nonce")
+
+    def test_memory_backend(self):
+        store = MemoryNonceStore()
+        expires = time.time() + 60
+        assert store.add(u"client", u"nonce", u"1", expires)
+        assert not store.add(u"client", u"nonce", u"1", expires)
+
+        # expired entries are dropped from the window
+        assert store.add(u"client", u"old", u"1", time.time() - 1)
+        assert store.add(u"client", u"new", u"1", expires)
+        assert len(store) == 2
+
+
+class TestIndexes(TestCase):
+
+    def test_declared_indexes_exist(self):
+        for table, result in index_report().items():
+            assert result["missing"] == [], table
+
+    def test_report_missing_and_unused(self):
+        Client.get_collection().drop_index("name_1")
+        Client.ensure_index("description")
+
+        report = index_report()["clients"]
+        assert report["missing"] == ["name_1"]
+        assert report["unused"] == ["description_1"]
+
+    def test_changed_index(self):
+        # as built before client_key was declared unique
+        Client.get_collection().drop_index("client_key_1")
+        Client.ensure_index("client_key")
+        assert index_report()["clients"]["changed"] == ["client_key_1"]
+
+        with self.assertRaises(IndexConflict):
+            ensure_indexes()
+        assert "clients.client_key_1" in ensure_indexes(rebuild=True)
+        assert index_report()["clients"]["changed"] == []
+        assert Client.get_collection().index_information()["client_key_1"]["unique"]
+
+    def test_app_starts_on_old_indexes(self):
+        Client.get_collection().drop_index("client_key_1")
+        Client.ensure_index("client_key")
+
+        class Config(TestConfig):
+            MONGO_ENSURE_INDEXES = True
+        app = create_app(Config)
+        with app.test_request_context():
+            assert "clients.client_key_1" in ensure_indexes(rebuild=True)
+            assert index_report()["clients"]["changed"] == []
+
+    def test_failed_rebuild_keeps_old_index(self):
+        Client.get_collection().drop_index("client_key_1")
+        Client.ensure_index("client_key")
+        Client.get_collection().insert({"client_key": "twice"})
+        Client.get_collection().insert({"client_key": "twice"})
+
+        with self.assertRaises(OperationFailure):
+            ensure_indexes(rebuild=True)
+        assert "client_key_1" in Client.get_collection().index_information()
+
+
+class TestGetOrCreateDevice(TestCase):
+
+    def test_existing_device(self):
+        device = get_or_create_device(self.known_access_token)
+        assert device["_id"] == self.known_device["_id"]
+
+    def test_new_device(self):
+        token = create_access_token("new_token", self.known_user, self.known_client)
+        device = get_or_create_device(token)
+        again = get_or_create_device(token)
+        assert device["_id"] == again["_id"]
+        assert Device.find({"access_token_id": token["_id"]}).count() == 1
+
+        assert device["resource_owner_id"] == self.known_user["_id"]
+
+    def test_unknown_user(self):
+        token = AccessToken(token="orphan_token")
+        token["resource_owner_id"] = ObjectId()
+        AccessToken.save(token)
+
+        with self.assertRaises(ApiException):
+            get_or_create_device(token)
+        assert Device.find_one({"access_token_id": token["_id"]}) is None
+        with self.assertRaises(ApiException):
+            get_or_create_device(token)
+
+
+class TestSweeper(TestCase):
+
+    def test_expired_tokens(self):
+        past = datetime.utcnow() - timedelta(seconds=5)
+        RequestToken.insert(RequestToken("expired", "cb", expires_at=past))
+        RequestToken.insert(RequestToken("legacy", "cb"))
+        token = create_access_token("expired_token", self.known_user, self.known_client)
+        AccessToken.modify({"_id": token["_id"]}, {"$set": {"expires_at": past}})
+
+        assert find_access_token("expired_token", self.known_client["_id"]) is None
+        sweep()
+        assert RequestToken.find_one({"token": "expired"}) is None
+        assert AccessToken.find_one({"token": "expired_token"}) is None
+        assert RequestToken.find_one({"token": "legacy"})["expires_at"] > datetime.utcnow()
+
+    def test_legacy_nonces(self):
+        Nonce.get_collection().insert({"nonce": "old", "timestamp": "1", "client_key": "k"})
+        sweep()
+        assert Nonce.find_one({"nonce": "old"})["expires_at"] > datetime.utcnow()
+        assert AccessToken.find_one({"token": "known_token"})
+
+    def test_prune_dangling(self):
+        before = reclaimed.value("users", "device_ids")
+        extra = ObjectId()
+        User.modify({"_id": self.known_user["_id"]},
+                    {"$push": {"device_ids": extra, "client_ids": ObjectId()}})
+        counts = sweep(batch_size=1)
+
+        user = User.find_one({"_id": self.known_user["_id"]})
+        assert user["device_ids"] == []
+        assert user["client_ids"] == []
+        assert counts["users.device_ids"] == 1
+        assert reclaimed.value("users", "device_ids") == before + 1
+        assert sweep(batch_size=1)["users.device_ids"] == 0
+
+
+class TestMigrateOwnership(TestCase):
+
+    def test_migrate(self):
+        token = create_access_token("other_token", self.known_user, self.known_client)
+        other = get_or_create_device(token)
+        # as stored before devices had an owner
+        Device.modify({}, {"$unset": {"resource_owner_id": 1}}, multi=True)
+        seeded_for = ObjectId()
+        User.modify({"_id": self.known_user["_id"]},
+                    {"$set": {"device_ids": [self.known_device["_id"]],
+                              "client_ids": [seeded_for],
+                              "access_tokens": [token["_id"]]}})
+        Client.modify({}, {"$set": {"access_tokens": []}}, multi=True)
+
+        counts = migrate_ownership(batch_size=1)
+        assert counts == {"devices": 2, "users": 1, "clients": 1}
+        for device_id in (self.known_device["_id"], other["_id"]):
+            device = Device.find_one({"_id": device_id})
+            assert device["resource_owner_id"] == self.known_user["_id"]
+        user = User.find_one({"_id": self.known_user["_id"]})
+        assert "device_ids" not in user and "access_tokens" not in user
+        assert "client_ids" not in user
+        assert user["seed_client_ids"] == [seeded_for]
+        assert "access_tokens" not in Client.find_one({"_id": self.known_client["_id"]})
+
+        assert migrate_ownership() == {"devices": 0, "users": 0, "clients": 0}
+
+
+class TestPartialSave(TestCase):
+
+    def load_user(self):
+        return User.load(User.find_one({"_id": self.known_user["_id"]}))
+
+    def test_changes(self):
+        user = self.load_user()
+        assert user.changes() == {}
+        user["name"] = "Renamed"
+        user.push("client_ids", "fake_id")
+        assert user.changes() == {
+            "$set": {"name": "Renamed"},
+            "$push": {"client_ids": {"$each": ["fake_id"]}},
+            }
+        assert User().changes() is None
+
+    def test_save_writes_changes_only(self):
+        user = self.load_user()
+        user["name"] = "Renamed"
+        user.push("client_ids", "fake_id")
+
+        # a concurrent write to a field this request did not touch
+        User.modify({"_id": user["_id"]}, {"$set": {"email": "new@example.com"}})
+
+        partial, written = write_stats["partial"], write_stats["bytes"]
+        reported = mongo_written_bytes.value("partial")
+        User.save(user)
+        assert write_stats["partial"] == partial + 1
+        assert write_stats["bytes"] - written < len(BSON.encode(user))
+        assert mongo_written_bytes.value("partial") - reported == \
+            write_stats["bytes"] - written
+        assert user.changes() == {}
+
+        saved = User.find_one({"_id": user["_id"]})
+        assert saved["name"] == "Renamed"
+        assert saved["email"] == "new@example.com"
+        assert saved["client_ids"][-1] == "fake_id"
+
+    def test_write_size_needs_metrics(self):
+        user = self.load_user()
+        user["name"] = "Renamed"
+        written = write_stats["bytes"]
+        metrics.enabled = False
+        try:
+            User.save(user)
+        finally:
+            metrics.init_app(self.app)
+        assert write_stats["bytes"] == written
+
+    def test_version_conflict(self):
+        user = self.load_user()
+        other = self.load_user()
+        other["updated_since"] = datetime.utcnow() + timedelta(seconds=1)
+        User.save(other, check_version=True)
+
+        user["name"] = "Renamed"
+        with self.assertRaises(ConflictException):
+            User.save(user, check_version=True)
+
+
+class TestMemoryEngine(TestCase):
+
+    def setUp(self):
+        super(TestMemoryEngine, self).setUp()
+        self.collection = MemoryClient()["mgserver_memory_test"]["things"]
+        for i in range(5):
+            self.collection.insert({"n": i, "tags": ["even" if i % 2 == 0 else "odd"]})
+
+    def tearDown(self):
+        MemoryClient().drop_database("mgserver_memory_test")
+        super(TestMemoryEngine, self).tearDown()
+
+    def test_queries(self):
+        find = lambda spec: sorted(d["n"] for d in self.collection.find(spec))
+        assert find({"n": {"$in": [1, 3, 7]}}) == [1, 3]
+        assert find({"n": {"$lt": 2}}) == [0, 1]
+        assert find({"tags": "odd"}) == [1, 3]
+        assert find({"$or": [{"n": 0}, {"n": {"$gte": 4}}]}) == [0, 4]
+        assert find({"missing": {"$exists": False}, "n": {"$ne": 2}}) == [0, 1, 3, 4]
+
+    def test_sort_limit_projection(self):
+        docs = list(self.collection.find({}, ["n"]).sort([("n", -1)]).limit(2))
+        assert [d["n"] for d in docs] == [4, 3]
+        assert sorted(docs[0].keys()) == ["_id", "n"]
+
+    def test_updates(self):
+        result = self.collection.update({"n": {"$lt": 2}},
+                                        {"$set": {"low": True},
+                                         "$push": {"tags": {"$each": ["a", "b"]}}},
+                                        multi=True)
+        assert result["n"] == 2
+        doc = self.collection.find_one({"n": 1})
+        assert doc["low"] and doc["tags"] == ["odd", "a", "b"]
+
+        doc = self.collection.find_and_modify({"n": 9}, {"$setOnInsert": {"new": 1}},
+                                              upsert=True, new=True)
+        assert doc["n"] == 9 and doc["new"] == 1
+        self.collection.update({"n": 9}, {"$addToSet": {"tags": "x"}})
+        self.collection.update({"n": 9}, {"$addToSet": {"tags": "x"}})
+        assert self.collection.find_one({"n": 9})["tags"] == ["x"]
+
+    def test_copies(self):
+        doc = self.collection.find_one({"n": 0})
+        doc["tags"].append("changed")
+        assert self.collection.find_one({"n": 0})["tags"] == ["even"]
+
+    def test_unique_index(self):
+        self.collection.create_index("n", unique=True)
+        with self.assertRaises(DuplicateKeyError):
+            self.collection.insert({"n": 1})
+        with self.assertRaises(DuplicateKeyError):
+            self.collection.update({"n": 2}, {"$set": {"n": 3}})
+        self.collection.update({"n": 2}, {"$set": {"n": 10}})
+        assert self.collection.find_one({"n": 10})
+        assert self.collection.find_one({"n": 2}) is None
+
+    def test_ttl_index(self):
+        self.collection.insert({"n": 100, "expires_at": datetime.utcnow() - timedelta(seconds=5)})
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+        assert self.collection.find_one({"n": 100}) is None
@@ -1,6 +1,9 @@
+from datetime import datetime
 from werkzeug.urls import url_quote
 from flask import url_for
-from mgserver.database import ResourceOwner as User, Client
+from mgserver.extensions import hasher
+from mgserver.database import ResourceOwner as User, Client, Device
+from mgserver.frontend.fragments import fragment_lookups
 from tests import TestCase
 
 
@@ -23,6 +26,38 @@ class TestViews(TestCase):
         response = self.client.get("/account")
         self.assert_template_used(name="account.html")
 
+    def test_user_loaded_from_cache(self):
+        self.login("known_user@example.com", "9527")
+        self.client.get("/account")
+        response = self.client.get("/account", headers={"X-Profile-Queries": "1"})
+        self.assert_200(response)
+        assert response.headers["X-Query-Count"] == "0"
+
+    def test_devices_fragment_cached(self):
+        self.login("known_user@example.com", "9527")
+        self.client.get("/devices")
+        hits = fragment_lookups.value("_devices.html", "hit")
+        response = self.client.get("/devices")
+        assert fragment_lookups.value("_devices.html", "hit") == hits + 1
+
+        Device.modify({"_id": self.known_device["_id"]},
+                      {"$set": {"name": "Renamed device",
+                                "updated_since": datetime.utcnow()}})
+        response = self.client.get("/devices")
+        assert "Renamed device" in response.data
+        assert fragment_lookups.value("_devices.html", "hit") == hits + 1
+
+    def test_apps_fragment_after_add(self):
+        self.login("known_user@example.com", "9527")
+        self.client.get("/apps")
+        self.client.post('/apps', data={
+                u"name": "Fake app",
+                u"description": "Official fake app for MGServer",
+                u"callback": "xxx://yyy.zzz",
+                })
+        response = self.client.get("/apps")
+        assert "Official fake app for MGServer" in response.data
+
     def test_add_app(self):
         self.login("known_user@example.com", "9527")
 
@@ -136,6 +171,13 @@ class TestViews(TestCase):
         assert "Invalid credentials" in response.data
         self.assert_template_used(name="login.html")
 
+    def test_login_without_password(self):
+        User.modify({"email": "known_user@example.com"},
+                    {"$set": {"pw_hash": ""}})
+        response = self.login("known_user@example.com",
+                              self.app.config["DUMMY_PASSWORD"])
+        assert "Invalid credentials" in response.data
+
     def test_already_login(self):
         self.login("known_user@example.com", "9527")
         response = self.login("known_user@example.com", "9527", follow_redirects=False)
@@ -156,3 +198,27 @@ class TestError(TestCase):
     def test_404(self):
         response = self.client.get('/404/')
         self.assert_404(response)
+
+
+class TestPasswordHasher(TestCase):
+
+    def test_rehash_on_login(self):
+        rounds = hasher.rounds
+        hasher.rounds = rounds + 1
+        try:
+            response = self.login("known_user@example.com", "9527")
+            assert "Signed in successfully." in response.data
+        finally:
+            hasher.rounds = rounds
+
+        user = User.find_one({"email": "known_user@example.com"})
+        assert user["pw_hash"].startswith("$2a$%02d$" % (rounds + 1))
+
+    def test_busy(self):
+        while hasher.slots.acquire(False):
+            pass
+        try:
+            response = self.login("known_user@example.com", "9527")
+            assert "try again later" in response.data
+        finally:
+            hasher.init_app(self.app)